@@ -58,13 +58,31 @@ def create_field(values, ifield, nb_layers, prolong_field=False):
     return field
 
 
+def get_neighbour_views(field):
+    """
+    Renvoie les neuf vues decalees de field donnant, pour chaque pixel entoure d'une couche de cellules dans field,
+    la valeur de l'un de ses voisins immediats (diagonale comprise) ou la sienne, ligne par ligne. La couche la plus
+    exterieure de field (les cellules fantomes de create_field) sert ainsi de "condition limite" sans aucune copie.
+    """
+    ny, nx = field.shape[0] - 2, field.shape[1] - 2
+    return [field[di:di + ny, dj:dj + nx] for di in range(3) for dj in range(3)]
+
+
+def sum_neighbour_views(views):
+    """
+    Somme les neuf vues de get_neighbour_views dans l'ordre de np.sum sur un bloc de 3x3 valeurs (sommation par
+    paires des huit premieres valeurs, puis ajout de la neuvieme), pour obtenir exactement les memes sommes qu'un
+    calcul pixel par pixel.
+    """
+    return ((views[0] + views[1]) + (views[2] + views[3])) + ((views[4] + views[5]) + (views[6] + views[7])) + views[8]
+
+
 def compute_means(intensity):
     """
     Calcule la moyenne de l'intensite d'un pixel et de ses voisins immediats (diagonale comprise)
     en utilisant la couche la plus extérieure des cellules fantomes de l'intensite comme "condition limite"
     """
-    return np.array([[(1. / 9.) * np.sum(intensity[i - 1:i + 2, j - 1:j + 2])
-                      for j in range(1, intensity.shape[1] - 1)] for i in range(1, intensity.shape[0] - 1)])
+    return (1. / 9.) * sum_neighbour_views(get_neighbour_views(intensity))
 
 
 def compute_variance(intensity, means):
@@ -73,147 +91,78 @@ def compute_variance(intensity, means):
     et l'intensite dont on utilise la couche la plus extérieure des cellules fantomes de l'intensite comme
     "condition limite".
     """
-    return np.array([[np.sum(np.power(intensity[i - 1:i + 2, j - 1:j + 2] - means[i - 1, j - 1], 2))
-                      for j in range(1, intensity.shape[1] - 1)] for i in range(1, intensity.shape[0] - 1)])
+    return sum_neighbour_views([np.power(view - means, 2) for view in get_neighbour_views(intensity)])
+
 
+# Decalages (ligne, colonne) des voisins d'un pixel et du pixel lui-meme, dans l'ordre de leurs colonnes dans la
+# ligne de la matrice correspondant au pixel
+STENCIL_OFFSETS = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)]
 
-def compute_wrs(intensity, means, variance, ir, jr, ic, jc):
+
+def compute_wrs(intensity, means, variance, shape, di, dj):
     """
-    Calcule un poids pour la contribution d'un pixel voisin (ic,jc) au pixel de coordonne (ir,jr)
-    en fonction de la correlation de l'intensite du pixel (ic,jc) avec le pixel (ir,jr)
+    Calcule, pour tous les pixels (ir,jr) a la fois, un poids pour la contribution de leur voisin (ir+di,jr+dj)
+    en fonction de la correlation de l'intensite du pixel voisin avec le pixel (ir,jr)
     """
+    ny, nx = shape
     # Prise en compte de la variance quand elle est nulle
-    sigma = max(variance[ir, jr], 0.000002)
-    mu_r = means[ir, jr]
+    sigma = np.maximum(variance[:ny, :nx], 0.000002)
+    mu_r = means[:ny, :nx]
     # +1 sur les index pour intensity a cause de la couche supplementaire de ghost cell pour intensity
-    return 1. + (intensity[ir + 1, jr + 1] - mu_r) * (intensity[ic + 1, jc + 1] - mu_r) / sigma
+    intensity_r = intensity[1:ny + 1, 1:nx + 1]
+    intensity_c = intensity[1 + di:ny + 1 + di, 1 + dj:nx + 1 + dj]
+    return 1. + (intensity_r - mu_r) * (intensity_c - mu_r) / sigma
 
 
-def assembly_row(
-        image_size, i_start, intensity, means, variance, pos, pt_rows, ind_cols, coefs
-):
+def compute_matrix(image_size, i_start, intensity, means, variance):
     """
-    Assemble la ligne de la matrice correspondant au pixel se trouvant a la position pos = (i,j)
-
-    Le stockage de la matrice est un stockage morse, c'est à dire :
+    Calcule la matrice issue de la minimisation de la fonction quadratique
 
-    Entrees :
+    La matrice est assemblee directement en stockage morse (csr), pour tous les pixels a la fois : pour chaque
+    decalage de STENCIL_OFFSETS, les poids de tous les pixels sont calcules sur des tableaux decales, les voisins
+    hors de l'image sont masques, puis les coefficients non nuls sont extraits ligne par ligne de la matrice.
 
     image_size represente la taille de l'image complete (sans cellules fantomes)
+    i_start    L'indice dans l'image complete de la premiere ligne de pixels
     intensity  L'intensite pour chaque pixel, avec deux couches de cellules fantomes
     means      La moyenne de chaque pixel avec ses voisins avec une couche de cellules fantomes
     variance   La variance de chaque pixel avec ses voisins avec une couche de cellules fantomes
-
-    Sorties:
-    
-    pt_rows represente le debut de chaque ligne de la matrice dans les tableaux ind_cols et coefs
-    ind_cols represente les indices colonnes de chaque element non nul de la matrice
-    coefs stocke les coefficients non nuls de la matrice
-    """
-    # nnz : nombre coefficients non nuls sur la ligne de la matrice :
-    nnz = 9
-    i_glob = i_start + pos[0]
-    if (i_glob == 0 or i_glob == image_size[1] - 1) and (pos[1] == 0 or pos[1] == image_size[0] - 1):
-        nnz = 4
-    elif (i_glob == 0 or i_glob == image_size[1] - 1) and not (pos[1] == 0 or pos[1] == image_size[0] - 1):
-        nnz = 6
-    elif not (i_glob == 0 or i_glob == image_size[1] - 1) and (pos[1] == 0 or pos[1] == image_size[0] - 1):
-        nnz = 6
-
-    index = pos[0] * image_size[0] + pos[1]
-    # Calcul de la position de la ligne suivante dans la matrice :
-    pt_rows[index + 1] = pt_rows[index] + nnz
-    # On commence a remplir ind_cols et coefs avec les coefficinets adequats pour la matrice
-    start = pt_rows[index]
-    nx = image_size[0]
-    ny = image_size[1]
-    sum = 0.
-    if i_glob > 0:
-        if pos[1] > 0:
-            ind_cols[start] = index - nx - 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] - 1, pos[1] - 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-        ind_cols[start] = index - nx
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] - 1, pos[1])
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-        if pos[1] < nx - 1:
-            ind_cols[start] = index - nx + 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] - 1, pos[1] + 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-    if pos[1] > 0:
-        ind_cols[start] = index - 1
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0], pos[1] - 1)
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-    pos_diag = start
-    ind_cols[start] = index
-    coefs[start] = +1.
-    start += 1
-    if pos[1] < nx - 1:
-        ind_cols[start] = index + 1
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0], pos[1] + 1)
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-    if i_glob < ny - 1:
-        if pos[1] > 0:
-            ind_cols[start] = index + nx - 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] + 1, pos[1] - 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-        ind_cols[start] = index + nx
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] + 1, pos[1])
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-        if pos[1] < nx - 1:
-            ind_cols[start] = index + nx + 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] + 1, pos[1] + 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-    # Normalisation des coefficients
-    start0 = pt_rows[index]
-    coefs[start0:pos_diag] /= sum
-    coefs[pos_diag + 1:start] /= sum
-
-
-def compute_matrix(image_size, i_start, intensity, means, variance):
-    """
-    Calcule la matrice issue de la minimisation de la fonction quadratique
     """
     ny = means.shape[0] - 2
     nx = means.shape[1] - 2
-    # Dimension de la matrice (rectangulaire pour interaction avec ghost cells )
-    dim = nx * ny
-    # Nombre d'elements non nuls prevus pour la matrice :
-    nnz = 9 * (nx - 2) * (ny - 2) + 12 * ((nx - 2) + (ny - 2)) + 16
-    if i_start > 0:
-        nnz += 3 * (nx - 2) - 8
-    if i_start + ny < image_size[1] - 1:
-        nnz += 3 * (nx - 2) - 8
+    # Pour chaque pixel (irow, jcol), on fait correspondre la ligne de la matrice d'indice irow*nx + jcol
+    i_glob = i_start + np.arange(ny)[:, np.newaxis]
+    jcol = np.arange(nx)[np.newaxis, :]
+    index = np.arange(ny)[:, np.newaxis] * image_size[0] + jcol
+    # Voisins existants dans l'image complete selon le decalage en ligne et en colonne
+    has_rows = {-1: i_glob > 0, 0: np.ones_like(i_glob, dtype=bool), 1: i_glob < image_size[1] - 1}
+    has_cols = {-1: jcol > 0, 0: np.ones_like(jcol, dtype=bool), 1: jcol < image_size[0] - 1}
+
+    # Coefficients des neuf colonnes possibles de chaque ligne, dont les non nuls sont masques par is_non_zero
+    is_non_zero = np.empty((ny, nx, len(STENCIL_OFFSETS)), dtype=bool)
+    ind_cols = np.empty((ny, nx, len(STENCIL_OFFSETS)), dtype=np.int64)
+    coefs = np.empty((ny, nx, len(STENCIL_OFFSETS)), dtype=np.double)
+    # Les poids sont sommes dans l'ordre des colonnes, comme ligne par ligne
+    sum = np.zeros((ny, nx), dtype=np.double)
+    for k, (di, dj) in enumerate(STENCIL_OFFSETS):
+        is_non_zero[:, :, k] = np.logical_and(has_rows[di], has_cols[dj])
+        ind_cols[:, :, k] = index + di * image_size[0] + dj
+        if di == 0 and dj == 0:
+            coefs[:, :, k] = +1.
+            continue
+        wrs = compute_wrs(intensity, means, variance, (ny, nx), di, dj)
+        sum += np.where(is_non_zero[:, :, k], wrs, 0.)
+        coefs[:, :, k] = -wrs
+    # Normalisation des coefficients hors diagonale
+    for k, (di, dj) in enumerate(STENCIL_OFFSETS):
+        if di != 0 or dj != 0:
+            coefs[:, :, k] /= sum
+
     # Indices du début des lignes dans les tableaux indCols et coefficients :
-    beg_rows = np.zeros(dim + 1, dtype=np.int64)
-    # Indices colonnes des elements non nuls :
-    ind_cols = np.empty(nnz, dtype=np.int64)
-    coefs = np.empty(nnz, dtype=np.double)
-
-    # Pour chaque pixel (irow, icol); on fait correspondre la ligne de la matrice d'indice irow*nx + icol
-    # On assemble la matrice ligne par ligne
-    for irow in range(ny):
-        for jcol in range(nx):
-            assembly_row(image_size, i_start, intensity, means, variance, (irow, jcol), beg_rows, ind_cols, coefs)
-    assert (beg_rows[-1] == nnz)
+    beg_rows = np.zeros(nx * ny + 1, dtype=np.int64)
+    np.cumsum(np.count_nonzero(is_non_zero, axis=2).ravel(), out=beg_rows[1:])
     # On retourne la matrice sous forme d'une matrice creuse stockee en csr avec scipy
-    return sparse.csr_matrix((coefs, ind_cols, beg_rows), dtype=np.double)
+    return sparse.csr_matrix((coefs[is_non_zero], ind_cols[is_non_zero], beg_rows), dtype=np.double)
 
 
 def search_fixed_colored_pixels(mark_values):
@@ -230,15 +179,17 @@ def search_fixed_colored_pixels(mark_values):
 def apply_dirichlet(A: sparse.csr_matrix, dirichlet: np.array):
     """
     Applique une condition de dirichlet aux endroits ou la couleur est deja definie a l'initiation
+
+    Les lignes et les colonnes des pixels fixes sont annulees (sauf la diagonale de leurs lignes, mise a un)
+    directement dans le tableau des coefficients de la matrice csr, a l'aide d'un masque des pixels fixes construit
+    une seule fois et de l'indice de ligne de chaque coefficient.
     """
-    for irow in range(A.shape[0]):
-        if irow in dirichlet:
-            A.data[A.indptr[irow]:A.indptr[irow + 1]] = [0. if A.indices[i] != irow else 1. for i in
-                                                         range(A.indptr[irow], A.indptr[irow + 1])]
-        else:
-            for jcol in range(A.indptr[irow], A.indptr[irow + 1]):
-                if A.indices[jcol] in dirichlet:
-                    A.data[jcol] = 0.
+    is_fixed = np.zeros(max(A.shape), dtype=bool)
+    is_fixed[dirichlet] = True
+    rows = np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+    in_fixed_row = is_fixed[rows]
+    A.data[np.logical_or(in_fixed_row, is_fixed[A.indices])] = 0.
+    A.data[np.logical_and(in_fixed_row, A.indices == rows)] = 1.
 
 
 def minimize(A: sparse.csr_matrix, b: np.array, x0: np.array, niters: int, epsilon: float):
@@ -5,7 +5,6 @@ os.environ['MKL_NUM_THREADS'] = '1'
 
 from PIL import Image
 import numpy as np
-from numpy import linalg
 from scipy import sparse
 import time
 import math
@@ -15,21 +14,12 @@ comm = MPI.COMM_WORLD
 size = comm.size
 rank = comm.rank
 
-# Tags form MPI communication
-MATRIX_VECTOR_TAG = 1
-MATRIX_VECTOR_DONE_TAG = 2
-STOP_TAG = 3
-EXIT_TAG = 4
-
-# Flag for the loop
-CALCULATING = True
-
 # File names
 GRAY_IMG_FILENAME = "example.bmp"
 MARKED_IMG_FILENAME = "example_marked.bmp"
 OUTPUT_FILENAME = "example.png"
 
-niters = 10
+niters = 50_000
 epsilon = 1.E-10
 
 HUE = 0
@@ -68,13 +58,31 @@ def create_field(values, ifield, nb_layers, prolong_field=False):
     return field
 
 
+def get_neighbour_views(field):
+    """
+    Renvoie les neuf vues decalees de field donnant, pour chaque pixel entoure d'une couche de cellules dans field,
+    la valeur de l'un de ses voisins immediats (diagonale comprise) ou la sienne, ligne par ligne. La couche la plus
+    exterieure de field (les cellules fantomes de create_field) sert ainsi de "condition limite" sans aucune copie.
+    """
+    ny, nx = field.shape[0] - 2, field.shape[1] - 2
+    return [field[di:di + ny, dj:dj + nx] for di in range(3) for dj in range(3)]
+
+
+def sum_neighbour_views(views):
+    """
+    Somme les neuf vues de get_neighbour_views dans l'ordre de np.sum sur un bloc de 3x3 valeurs (sommation par
+    paires des huit premieres valeurs, puis ajout de la neuvieme), pour obtenir exactement les memes sommes qu'un
+    calcul pixel par pixel.
+    """
+    return ((views[0] + views[1]) + (views[2] + views[3])) + ((views[4] + views[5]) + (views[6] + views[7])) + views[8]
+
+
 def compute_means(intensity):
     """
     Calcule la moyenne de l'intensite d'un pixel et de ses voisins immediats (diagonale comprise)
     en utilisant la couche la plus extérieure des cellules fantomes de l'intensite comme "condition limite"
     """
-    return np.array([[(1. / 9.) * np.sum(intensity[i - 1:i + 2, j - 1:j + 2])
-                      for j in range(1, intensity.shape[1] - 1)] for i in range(1, intensity.shape[0] - 1)])
+    return (1. / 9.) * sum_neighbour_views(get_neighbour_views(intensity))
 
 
 def compute_variance(intensity, means):
@@ -83,150 +91,82 @@ def compute_variance(intensity, means):
     et l'intensite dont on utilise la couche la plus extérieure des cellules fantomes de l'intensite comme
     "condition limite".
     """
-    return np.array([[np.sum(np.power(intensity[i - 1:i + 2, j - 1:j + 2] - means[i - 1, j - 1], 2))
-                      for j in range(1, intensity.shape[1] - 1)] for i in range(1, intensity.shape[0] - 1)])
+    return sum_neighbour_views([np.power(view - means, 2) for view in get_neighbour_views(intensity)])
 
 
-def compute_wrs(intensity, means, variance, ir, jr, ic, jc):
+# Decalages (ligne, colonne) des voisins d'un pixel et du pixel lui-meme, dans l'ordre de leurs colonnes dans la
+# ligne de la matrice correspondant au pixel
+STENCIL_OFFSETS = [(di, dj) for di in (-1, 0, 1) for dj in (-1, 0, 1)]
+
+
+def compute_wrs(intensity, means, variance, shape, di, dj):
     """
-    Calcule un poids pour la contribution d'un pixel voisin (ic,jc) au pixel de coordonne (ir,jr)
-    en fonction de la correlation de l'intensite du pixel (ic,jc) avec le pixel (ir,jr)
+    Calcule, pour tous les pixels (ir,jr) a la fois, un poids pour la contribution de leur voisin (ir+di,jr+dj)
+    en fonction de la correlation de l'intensite du pixel voisin avec le pixel (ir,jr)
     """
+    ny, nx = shape
     # Prise en compte de la variance quand elle est nulle
-    sigma = max(variance[ir, jr], 0.000002)
-    mu_r = means[ir, jr]
+    sigma = np.maximum(variance[:ny, :nx], 0.000002)
+    mu_r = means[:ny, :nx]
     # +1 sur les index pour intensity a cause de la couche supplementaire de ghost cell pour intensity
-    return 1. + (intensity[ir + 1, jr + 1] - mu_r) * (intensity[ic + 1, jc + 1] - mu_r) / sigma
+    intensity_r = intensity[1:ny + 1, 1:nx + 1]
+    intensity_c = intensity[1 + di:ny + 1 + di, 1 + dj:nx + 1 + dj]
+    return 1. + (intensity_r - mu_r) * (intensity_c - mu_r) / sigma
 
 
-def assembly_row(image_size, i_start, intensity, means, variance, pos, pt_rows, ind_cols, coefs):
+def compute_matrix(image_size, i_start, intensity, means, variance):
     """
-    Assemble la ligne de la matrice correspondant au pixel se trouvant a la position pos = (i,j)
-
-    Le stockage de la matrice est un stockage morse, c'est à dire :
+    Calcule la matrice issue de la minimisation de la fonction quadratique
 
-    Entrees :
+    La matrice est assemblee directement en stockage morse (csr), pour tous les pixels a la fois : pour chaque
+    decalage de STENCIL_OFFSETS, les poids de tous les pixels sont calcules sur des tableaux decales, les voisins
+    hors de l'image sont masques, puis les coefficients non nuls sont extraits ligne par ligne de la matrice.
+    Pour une bande de lignes de l'image, seul le bloc de lignes correspondant de la matrice globale est calcule, avec
+    les indices de colonnes de la matrice globale.
 
     image_size represente la taille de l'image complete (sans cellules fantomes)
+    i_start    L'indice dans l'image complete de la premiere ligne de pixels
     intensity  L'intensite pour chaque pixel, avec deux couches de cellules fantomes
     means      La moyenne de chaque pixel avec ses voisins avec une couche de cellules fantomes
     variance   La variance de chaque pixel avec ses voisins avec une couche de cellules fantomes
-
-    Sorties:
-    
-    pt_rows represente le debut de chaque ligne de la matrice dans les tableaux ind_cols et coefs
-    ind_cols represente les indices colonnes de chaque element non nul de la matrice
-    coefs stocke les coefficients non nuls de la matrice
-    """
-    # nnz : nombre coefficients non nuls sur la ligne de la matrice :
-    nnz = 9
-    i_glob = i_start + pos[0]
-    if (i_glob == 0 or i_glob == image_size[1] - 1) and (pos[1] == 0 or pos[1] == image_size[0] - 1):
-        nnz = 4
-    elif (i_glob == 0 or i_glob == image_size[1] - 1) and not (pos[1] == 0 or pos[1] == image_size[0] - 1):
-        nnz = 6
-    elif not (i_glob == 0 or i_glob == image_size[1] - 1) and (pos[1] == 0 or pos[1] == image_size[0] - 1):
-        nnz = 6
-
-    index = pos[0] * image_size[0] + pos[1]
-    # Calcul de la position de la ligne suivante dans la matrice :
-    pt_rows[index + 1] = pt_rows[index] + nnz
-    # On commence a remplir ind_cols et coefs avec les coefficinets adequats pour la matrice
-    start = pt_rows[index]
-    nx = image_size[0]
-    ny = image_size[1]
-    sum = 0.
-    if i_glob > 0:
-        if pos[1] > 0:
-            ind_cols[start] = index - nx - 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] - 1, pos[1] - 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-        ind_cols[start] = index - nx
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] - 1, pos[1])
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-        if pos[1] < nx - 1:
-            ind_cols[start] = index - nx + 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] - 1, pos[1] + 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-    if pos[1] > 0:
-        ind_cols[start] = index - 1
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0], pos[1] - 1)
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-    pos_diag = start
-    ind_cols[start] = index
-    coefs[start] = +1.
-    start += 1
-    if pos[1] < nx - 1:
-        ind_cols[start] = index + 1
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0], pos[1] + 1)
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-    if i_glob < ny - 1:
-        if pos[1] > 0:
-            ind_cols[start] = index + nx - 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] + 1, pos[1] - 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-        ind_cols[start] = index + nx
-        wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] + 1, pos[1])
-        sum += wrs
-        coefs[start] = -wrs
-        start += 1
-        if pos[1] < nx - 1:
-            ind_cols[start] = index + nx + 1
-            wrs = compute_wrs(intensity, means, variance, pos[0], pos[1], pos[0] + 1, pos[1] + 1)
-            sum += wrs
-            coefs[start] = -wrs
-            start += 1
-    # Normalisation des coefficients
-    start0 = pt_rows[index]
-    coefs[start0:pos_diag] /= sum
-    coefs[pos_diag + 1:start] /= sum
-
-
-def compute_matrix(image_size, i_start, intensity, means, variance):
-    """
-    Calcule la matrice issue de la minimisation de la fonction quadratique
     """
     ny = means.shape[0] - 2
     nx = means.shape[1] - 2
-
-    # Dimension de la matrice (rectangulaire pour interaction avec ghost cells)
-    dim = nx * ny
-
-    # Nombre d'elements non nuls prevus pour la matrice :
-    nnz = 9 * (nx - 2) * (ny - 2) + 12 * ((nx - 2) + (ny - 2)) + 16
-    if i_start > 0:
-        nnz += 3 * (nx - 2) - 8
-    if i_start + ny < image_size[1] - 1:
-        nnz += 3 * (nx - 2) - 8
+    # Pour chaque pixel (irow, jcol), on fait correspondre la ligne de la matrice d'indice irow*nx + jcol
+    # et la colonne de la matrice globale d'indice (i_start + irow)*nx + jcol
+    i_glob = i_start + np.arange(ny)[:, np.newaxis]
+    jcol = np.arange(nx)[np.newaxis, :]
+    global_index = i_glob * image_size[0] + jcol
+    # Voisins existants dans l'image complete selon le decalage en ligne et en colonne
+    has_rows = {-1: i_glob > 0, 0: np.ones_like(i_glob, dtype=bool), 1: i_glob < image_size[1] - 1}
+    has_cols = {-1: jcol > 0, 0: np.ones_like(jcol, dtype=bool), 1: jcol < image_size[0] - 1}
+
+    # Coefficients des neuf colonnes possibles de chaque ligne, dont les non nuls sont masques par is_non_zero
+    is_non_zero = np.empty((ny, nx, len(STENCIL_OFFSETS)), dtype=bool)
+    ind_cols = np.empty((ny, nx, len(STENCIL_OFFSETS)), dtype=np.int64)
+    coefs = np.empty((ny, nx, len(STENCIL_OFFSETS)), dtype=np.double)
+    # Les poids sont sommes dans l'ordre des colonnes, comme ligne par ligne
+    sum = np.zeros((ny, nx), dtype=np.double)
+    for k, (di, dj) in enumerate(STENCIL_OFFSETS):
+        is_non_zero[:, :, k] = np.logical_and(has_rows[di], has_cols[dj])
+        ind_cols[:, :, k] = global_index + di * image_size[0] + dj
+        if di == 0 and dj == 0:
+            coefs[:, :, k] = +1.
+            continue
+        wrs = compute_wrs(intensity, means, variance, (ny, nx), di, dj)
+        sum += np.where(is_non_zero[:, :, k], wrs, 0.)
+        coefs[:, :, k] = -wrs
+    # Normalisation des coefficients hors diagonale
+    for k, (di, dj) in enumerate(STENCIL_OFFSETS):
+        if di != 0 or dj != 0:
+            coefs[:, :, k] /= sum
 
     # Indices du début des lignes dans les tableaux indCols et coefficients :
-    beg_rows = np.zeros(dim + 1, dtype=np.int64)
-
-    # Indices colonnes des elements non nuls :
-    ind_cols = np.empty(nnz, dtype=np.int64)
-    coefs = np.empty(nnz, dtype=np.double)
-
-    # Pour chaque pixel (irow, icol); on fait correspondre la ligne de la matrice d'indice irow*nx + icol
-    # On assemble la matrice ligne par ligne
-    for irow in range(ny):
-        for jcol in range(nx):
-            assembly_row(image_size, i_start, intensity, means, variance, (irow, jcol), beg_rows, ind_cols, coefs)
-    assert (beg_rows[-1] == nnz)
-
+    beg_rows = np.zeros(nx * ny + 1, dtype=np.int64)
+    np.cumsum(np.count_nonzero(is_non_zero, axis=2).ravel(), out=beg_rows[1:])
     # On retourne la matrice sous forme d'une matrice creuse stockee en csr avec scipy
-    return sparse.csr_matrix((coefs, ind_cols, beg_rows), dtype=np.double)
+    return sparse.csr_matrix((coefs[is_non_zero], ind_cols[is_non_zero], beg_rows),
+                             shape=(nx * ny, image_size[0] * image_size[1]), dtype=np.double)
 
 
 def search_fixed_colored_pixels(mark_values):
@@ -240,228 +180,274 @@ def search_fixed_colored_pixels(mark_values):
     return np.nonzero((hue != 0.) * (saturation != 0.))[0]
 
 
-def apply_dirichlet(A: sparse.csr_matrix, dirichlet: np.array):
+def apply_dirichlet(A: sparse.csr_matrix, dirichlet: np.array, row_offset: int = 0):
     """
     Applique une condition de dirichlet aux endroits ou la couleur est deja definie a l'initiation
+
+    Les lignes et les colonnes des pixels fixes sont annulees (sauf la diagonale de leurs lignes, mise a un)
+    directement dans le tableau des coefficients de la matrice csr, a l'aide d'un masque des pixels fixes construit
+    une seule fois et de l'indice de ligne de chaque coefficient.
+    A peut n'etre qu'un bloc de lignes de la matrice globale (avec les indices de colonnes globaux) : row_offset est
+    alors l'indice global de sa premiere ligne.
+    """
+    is_fixed = np.zeros(max(A.shape[0] + row_offset, A.shape[1]), dtype=bool)
+    is_fixed[dirichlet] = True
+    rows = row_offset + np.repeat(np.arange(A.shape[0]), np.diff(A.indptr))
+    in_fixed_row = is_fixed[rows]
+    A.data[np.logical_or(in_fixed_row, is_fixed[A.indices])] = 0.
+    A.data[np.logical_and(in_fixed_row, A.indices == rows)] = 1.
+
+
+def get_row_bands(height):
     """
-    for irow in range(A.shape[0]):
-        if irow in dirichlet:
-            A.data[A.indptr[irow]:A.indptr[irow + 1]] = [0. if A.indices[i] != irow else 1. for i in
-                                                         range(A.indptr[irow], A.indptr[irow + 1])]
-        else:
-            for jcol in range(A.indptr[irow], A.indptr[irow + 1]):
-                if A.indices[jcol] in dirichlet:
-                    A.data[jcol] = 0.
-
-
-def get_matrix_vector_product(matrix, vector):
-    dim = vector.shape[0]
-    n_fragments = size
-    lines_per_fragment = math.ceil(dim / n_fragments)
-
-    for i in range(1, size):
-        start_i = lines_per_fragment * i
-        end_i = start_i + lines_per_fragment
-        if i == size - 1:
-            end_i = start_i + math.floor(dim / n_fragments)
-        matrix_fragment = matrix[start_i:end_i]
-        comm.send((matrix_fragment, vector), dest=i, tag=MATRIX_VECTOR_TAG)
-
-    result = []
-    # Here we calculate the first fragment on master while slave p-s are busy
-    result_part = matrix[0:lines_per_fragment].dot(vector)
-    result.append(result_part)
-
-    for i in range(1, size):
-        (result_part, i) = comm.recv(source=i, tag=MATRIX_VECTOR_DONE_TAG)
-        result.append(result_part)
-
-    return np.hstack(result)
-
-
-def minimize(A: sparse.csr_matrix, b: np.array, x0: np.array, niters: int, epsilon: float):
+    Decoupe les lignes de l'image en une bande de lignes consecutives par processus, la premiere pour le processus 0
+
+    Retourne les indices des premieres lignes des bandes, suivis du nombre de lignes de l'image.
     """
-    Minimise la fonction quadratique a l'aide d'un gradient conjugue
+    assert size <= height, "Il faut au plus un processus par ligne de l'image"
+    return [math.floor(i * height / size) for i in range(size + 1)]
+
+
+class DistributedMatrix:
     """
-    a_dot_x0 = get_matrix_vector_product(A, x0)
-    r = b - a_dot_x0
-    nrm_r0 = linalg.norm(r)
+    Bloc de lignes de la matrice globale detenu par le processus courant : les lignes des pixels de sa bande.
 
-    a_transposed_dot_r = get_matrix_vector_product(A.transpose(), r)
-    gc = a_transposed_dot_r
+    Les vecteurs sont distribues de la meme facon. Les colonnes non nulles du bloc ne concernent que les pixels de
+    la bande et ceux des lignes de l'image juste au-dessus et au-dessous (le halo) : pour les produits
+    matrice-vecteur, seules ces deux lignes du vecteur sont echangees avec les processus voisins.
+    """
 
-    x = np.copy(x0)
-    p = np.copy(gc)
+    def __init__(self, A: sparse.csr_matrix, row_start: int, width: int):
+        """
+        A         Le bloc de lignes, avec les indices de colonnes de la matrice globale
+        row_start L'indice dans l'image complete de la premiere ligne de la bande
+        width     Le nombre de pixels par ligne de l'image
+        """
+        self.width = width
+        self.dim = A.shape[0]
+        self.north = rank - 1 if rank > 0 else MPI.PROC_NULL
+        self.south = rank + 1 if rank < size - 1 else MPI.PROC_NULL
+        # Colonnes renumerotees dans le vecteur etendu : ligne du halo nord, bande, puis ligne du halo sud
+        ind_cols = A.indices - (row_start - 1) * width
+        self.block = sparse.csr_matrix((A.data, ind_cols, A.indptr), shape=(self.dim, self.dim + 2 * width))
+        self.transposed_block = self.block.transpose().tocsr()
+        self.extended = np.zeros(self.dim + 2 * width, dtype=np.double)
+
+    def dot(self, x: np.array):
+        """
+        Produit du bloc de lignes par le vecteur distribue x, apres reception du halo de x
+        """
+        w = self.width
+        self.extended[w:-w] = x
+        comm.Sendrecv(self.extended[w:2 * w], dest=self.north, recvbuf=self.extended[-w:], source=self.south)
+        comm.Sendrecv(self.extended[-2 * w:-w], dest=self.south, recvbuf=self.extended[:w], source=self.north)
+        return self.block.dot(self.extended)
+
+    def transpose_dot(self, r: np.array):
+        """
+        Produit de la transposee de la matrice globale par le vecteur distribue r
+
+        Le produit local contribue aussi aux lignes du halo : ces contributions sont envoyees aux processus voisins,
+        qui les ajoutent a leurs premiere et derniere lignes.
+        """
+        w = self.width
+        y = self.transposed_block.dot(r)
+        from_north = np.zeros(w, dtype=np.double)
+        from_south = np.zeros(w, dtype=np.double)
+        comm.Sendrecv(y[:w], dest=self.north, recvbuf=from_south, source=self.south)
+        comm.Sendrecv(y[-w:], dest=self.south, recvbuf=from_north, source=self.north)
+        y = y[w:-w]
+        y[:w] += from_north
+        y[-w:] += from_south
+        return y
+
+
+def get_norm(v: np.array):
+    """
+    Norme euclidienne du vecteur distribue v : les sommes des carres locales sont reduites sur tous les processus
+    """
+    squares = np.array(v.dot(v))
+    comm.Allreduce(MPI.IN_PLACE, squares, op=MPI.SUM)
+    return math.sqrt(squares)
 
-    a_dot_p = get_matrix_vector_product(A, p)
-    cp = a_dot_p
 
-    nrm_gc = linalg.norm(gc)
-    nrm_cp = linalg.norm(cp)
+def minimize(A: DistributedMatrix, b: np.array, x0: np.array, niters: int, epsilon: float):
+    """
+    Minimise la fonction quadratique a l'aide d'un gradient conjugue
+
+    Chaque processus ne calcule que sa partie des vecteurs ; les produits par la matrice et sa transposee sont
+    recalcules a chaque iteration, les normes sont reduites sur tous les processus.
+    """
+    r = b - A.dot(x0)
+    nrm_r0 = get_norm(r)
+    gc = A.transpose_dot(r)
+    x = np.copy(x0)
+    p = np.copy(gc)
+    cp = A.dot(p)
+    nrm_gc = get_norm(gc)
+    nrm_cp = get_norm(cp)
     alpha = nrm_gc * nrm_gc / (nrm_cp * nrm_cp)
     x += alpha * p
     r -= alpha * cp
-    nrm_r = linalg.norm(r)
+    nrm_r = get_norm(r)
     gp = np.copy(gc)
     nrm_gp = nrm_gc
-    gc = a_transposed_dot_r
+    gc = A.transpose_dot(r)
 
     for i in range(1, niters):
-        print(f"Iteration {i:06}/{niters:06} -> ||r||/||r0|| = {nrm_r / nrm_r0:16.14}", end='\r')
-        nrm_gc = linalg.norm(gc)
+        if rank == 0:
+            print(f"Iteration {i:06}/{niters:06} -> ||r||/||r0|| = {nrm_r / nrm_r0:16.14}", end='\r')
+        nrm_gc = get_norm(gc)
 
         if nrm_gc < 1.E-14:
             return x
 
         beta = -nrm_gc * nrm_gc / (nrm_gp * nrm_gp)
         p = gc - beta * p
-        cp = a_dot_p
-        nrm_cp = linalg.norm(cp)
+        cp = A.dot(p)
+        nrm_cp = get_norm(cp)
         alpha = nrm_gc * nrm_gc / (nrm_cp * nrm_cp)
         x += alpha * p
         r -= alpha * cp
         gp = np.copy(gc)
         nrm_gp = nrm_gc
-        gc = a_transposed_dot_r
-        nrm_r = linalg.norm(r)
+        gc = A.transpose_dot(r)
+        nrm_r = get_norm(r)
 
         if nrm_r < epsilon * nrm_r0:
             break
     return x
 
 
+def print_time(message, duration):
+    """
+    Affiche une duree mesuree sur le processus 0
+    """
+    if rank == 0:
+        print(f"{message} : {duration} secondes")
+
+
 def colorize(image, marked_image):
+    """
+    Colorise l'image avec tous les processus, chacun sur sa bande de lignes de l'image
+
+    Retourne l'image colorisee sur le processus 0, None sur les autres processus.
+    """
     # On convertit l'image en tableau (ny x nx x 3) (Trois pour les trois composantes de la couleur)
     values_gray = np.array(image)
+    height, width = values_gray.shape[:2]
+    row_starts = get_row_bands(height)
+    row_start, row_end = row_starts[rank], row_starts[rank + 1]
 
-    # On créer le tableau d'intensite en rajoutant deux couches de cellules fantomes dans chaque direction :
-    intensity = (1. / 255.) * create_field(values_gray, INTENSITY, nb_layers=2, prolong_field=True)
+    # On créer le tableau d'intensite en rajoutant deux couches de cellules fantomes dans chaque direction,
+    # puis on n'en garde que la bande du processus avec ses deux lignes de cellules fantomes de part et d'autre :
+    field = (1. / 255.) * create_field(values_gray, INTENSITY, nb_layers=2, prolong_field=True)
+    intensity = field[row_start:row_end + 4]
 
     # Calcul de la moyenne de l'intensite pour chaque pixel avec ses huit voisins
     # La moyenne contient une couche de cellules fantomes (une de moins que l'intensite)
     deb = time.time()
     means = compute_means(intensity)
     end = time.time() - deb
-    print(f"Temps calcul moyenne : {end} secondes")
+    print_time("Temps calcul moyenne", end)
 
     # Calcul de la variance de l'intensite pour chaque pixel avec ses huit voisins
     # La variance contient une couche de cellules fantomes comme la moyenne.
     deb = time.time()
     variance = compute_variance(intensity, means)
     end = time.time() - deb
-    print(f"Temps calcul variance : {end} secondes")
+    print_time("Temps calcul variance", end)
 
-    # Calcul de la matrice utilisee pour minimiser la fonction quadratique
+    # Calcul du bloc de lignes de la matrice utilisee pour minimiser la fonction quadratique
     deb = time.time()
-    A = compute_matrix((means.shape[1] - 2, means.shape[0] - 2), 0, intensity, means, variance)
+    A = compute_matrix((width, height), row_start, intensity, means, variance)
     end = time.time() - deb
-    print(f"Temps calcul matrice : {end} secondes")
+    print_time("Temps calcul matrice", end)
 
-    # Calcul des seconds membres
+    # Calcul des seconds membres, sur la bande du processus
     im_ycbcr = marked_image.convert('YCbCr')
-    val_ycbcr = np.array(im_ycbcr)
+    val_ycbcr = np.array(im_ycbcr)[row_start:row_end]
     # Les composantes Cb (bleu) et Cr (Rouge) sont normalisees :
     Cb = (1. / 255.) * np.array(val_ycbcr[:, :, CB].flat, dtype=np.double)
     Cr = (1. / 255.) * np.array(val_ycbcr[:, :, CR].flat, dtype=np.double)
 
     deb = time.time()
-    b_Cb = -A.dot(Cb)
-    b_Cr = -A.dot(Cr)
+    distributed_A = DistributedMatrix(A, row_start, width)
+    b_Cb = -distributed_A.dot(Cb)
+    b_Cr = -distributed_A.dot(Cr)
     end = time.time() - deb
-    print(f"Temps calcul des deux seconds membres : {end} secondes")
+    print_time("Temps calcul des deux seconds membres", end)
 
     im_hsv = marked_image.convert("HSV")
     val_hsv = np.array(im_hsv)
     deb = time.time()
     fix_coul_indices = search_fixed_colored_pixels(val_hsv)
     end = time.time() - deb
-    print(f"Temps recherche couleur fixee : {end} secondes")
+    print_time("Temps recherche couleur fixee", end)
 
-    # Application de la condition de Dirichlet sur la matrice :
+    # Application de la condition de Dirichlet sur le bloc de lignes de la matrice :
     deb = time.time()
-    apply_dirichlet(A, fix_coul_indices)
+    apply_dirichlet(A, fix_coul_indices, row_start * width)
+    distributed_A = DistributedMatrix(A, row_start, width)
     end = time.time() - deb
-    print(f"Temps application dirichlet sur matrice : {end} secondes")
+    print_time("Temps application dirichlet sur matrice", end)
 
-    print(f"Minimisation de la quadratique pour la composante Cb de l'image couleur")
+    if rank == 0:
+        print(f"Minimisation de la quadratique pour la composante Cb de l'image couleur")
     deb = time.time()
     x0 = np.zeros(Cb.shape, dtype=np.double)
-    new_Cb = Cb + minimize(A, b_Cb, x0, niters, epsilon)
-    print(f"\nTemps calcul min Cb : {time.time() - deb}")
+    new_Cb = Cb + minimize(distributed_A, b_Cb, x0, niters, epsilon)
+    if rank == 0:
+        print(f"\nTemps calcul min Cb : {time.time() - deb}")
 
-    print(f"Minimisation de la quadratique pour la composante Cr de l'image couleur")
+    if rank == 0:
+        print(f"Minimisation de la quadratique pour la composante Cr de l'image couleur")
     deb = time.time()
     x0 = np.zeros(Cr.shape, dtype=np.double)
-    new_Cr = Cr + minimize(A, b_Cr, x0, niters, epsilon)
-    print(f"\nTemps calcul min Cr : {time.time() - deb}")
+    new_Cr = Cr + minimize(distributed_A, b_Cr, x0, niters, epsilon)
+    if rank == 0:
+        print(f"\nTemps calcul min Cr : {time.time() - deb}")
+
+    # On rassemble les bandes des composantes Cb et Cr sur le processus 0
+    counts = np.diff(row_starts) * width
+    displacements = np.array(row_starts[:-1]) * width
+    global_Cb = np.empty(height * width, dtype=np.double) if rank == 0 else None
+    global_Cr = np.empty(height * width, dtype=np.double) if rank == 0 else None
+    comm.Gatherv(new_Cb, [global_Cb, counts, displacements, MPI.DOUBLE], root=0)
+    comm.Gatherv(new_Cr, [global_Cr, counts, displacements, MPI.DOUBLE], root=0)
+    if rank != 0:
+        return None
 
     # On remet les valeurs des trois composantes de l'image couleur YCbCr entre 0 et 255 :
-    new_Cb *= 255.
-    new_Cr *= 255.
-    intensity *= 255.
+    global_Cb *= 255.
+    global_Cr *= 255.
 
     # Puis, on sauve l'image dans un fichier :
-    shape = (means.shape[0] - 2, means.shape[1] - 2)
+    shape = (height, width)
     new_image_array = np.empty((shape[0], shape[1], 3), dtype=np.uint8)
-    new_image_array[:, :, 0] = intensity[2:-2, 2:-2].astype('uint8')
-    new_image_array[:, :, 1] = np.reshape(new_Cb, shape).astype('uint8')
-    new_image_array[:, :, 2] = np.reshape(new_Cr, shape).astype('uint8')
+    new_image_array[:, :, 0] = (255. * field[2:-2, 2:-2]).astype('uint8')
+    new_image_array[:, :, 1] = np.reshape(global_Cb, shape).astype('uint8')
+    new_image_array[:, :, 2] = np.reshape(global_Cr, shape).astype('uint8')
     new_im = Image.fromarray(new_image_array, mode='YCbCr')
 
     # Convert to RGB
     return new_im.convert('RGB')
 
 
-def master():
+"""
+Dans un deuxième temps, construire une partie de la matrice globale (correspondant à l'image complète)
+et paralléliser les produits matrice-vecteur ainsi que le gradient conjugué
+afin de résoudre un problème global en parallèle plutôt que plusieurs problèmes locaux.
+"""
+if __name__ == '__main__':
     im_gray = Image.open(GRAY_IMG_FILENAME).convert('HSV')
     im_marked = Image.open(MARKED_IMG_FILENAME)
 
     # Start the timer
     start_time = time.time()
 
-    # Colorize the image
+    # Colorize the image, each process on its band of rows
     colorized_image = colorize(im_gray, im_marked)
-    colorized_image.save(OUTPUT_FILENAME, 'PNG')
-    colorisation_time_end = time.time()
-    print("Colorisation is ready", colorisation_time_end - start_time)
-
-    # Send stop signals to all slaves
-    for i in range(1, size):
-        comm.send(None, dest=i, tag=STOP_TAG)
-
-    # Wait for all slaves to finish
-    for i in range(1, size):
-        comm.recv(source=MPI.ANY_SOURCE, tag=EXIT_TAG)
-
-    MPI.Finalize()
-    exit(0)
-
-
-def slave():
-    status = MPI.Status()
-
-    # Receive the matrix and vector from the master
-    matrix, vector = comm.recv(source=0, tag=MATRIX_VECTOR_TAG)
-
-    # Perform matrix-vector multiplication until stopped
-    while CALCULATING:
-        # Check if the master sent a stop signal
-        if status.Get_tag() == STOP_TAG:
-            # Send exit signal and terminate
-            comm.send(obj=None, dest=0, tag=EXIT_TAG)
-            exit(0)
-
-        product = matrix.dot(vector)
-        comm.send((product, rank), dest=0, tag=MATRIX_VECTOR_DONE_TAG)
-
-
-"""
-Dans un deuxième temps, construire une partie de la matrice globale (correspondant à l'image complète)
-et paralléliser les produits matrice-vecteur ainsi que le gradient conjugué
-afin de résoudre un problème global en parallèle plutôt que plusieurs problèmes locaux.
-"""
-if __name__ == '__main__':
     if rank == 0:
-        master()
-    else:
-        slave()
+        colorized_image.save(OUTPUT_FILENAME, 'PNG')
+        print("Colorisation is ready", time.time() - start_time)
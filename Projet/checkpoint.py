@@ -0,0 +1,127 @@
+"""
+Checkpoints of the simulation, to resume a run or to start a run without generating its maze.
+
+A checkpoint is a directory holding a small JSON header (step, food collected and parameters of the run) and one
+.npy file per array: the maze, the pheromones of the whole maze with their padding, and the packed state of the
+ants. The processes write and read these files in place through memory maps, each one only its own part: its
+band of rows of the pheromones and its ants.
+"""
+import json
+import os
+
+import numpy as np
+from numpy.lib.format import open_memmap
+import colony
+from mpi_init import initialize_mpi
+
+# Initialize MPI communication
+comm, rank, size, new_comm, comm_display, rank_new, size_new = initialize_mpi()
+
+HEADER = "header.json"
+MAZE = "maze.npy"
+PHEROMONES = "pheromones.npy"
+ANTS = "ants.npy"
+
+
+def save_checkpoint(path, header, a_maze, pheromones, ants):
+    """
+    Writes the state of the simulation in a checkpoint. Must be called by all the processes.
+
+    The header is written last, so an interrupted checkpoint has no header and cannot be loaded.
+
+    Args:
+        path (str): Directory of the checkpoint, created if needed.
+        header (dict): Step, food collected and parameters of the run, written by rank 0.
+        a_maze: The maze.
+        pheromones: The pheromones of the current process.
+        ants: The colony of the current process.
+    """
+    pheromones.complete_merge()
+
+    # Rank 0 only displays the ants of the computing processes, it does not own any
+    counts = comm.allgather(0 if rank == 0 else ants.directions.shape[0])
+    if rank == 1:
+        os.makedirs(path, exist_ok=True)
+        if os.path.exists(os.path.join(path, HEADER)):
+            os.remove(os.path.join(path, HEADER))
+        # A restored maze maps the maze file of its checkpoint: saving it again in place would truncate the mapped file
+        if not maps_file(a_maze.maze, os.path.join(path, MAZE)):
+            np.save(os.path.join(path, MAZE), a_maze.maze)
+        shape = (a_maze.maze.shape[0] + 2, a_maze.maze.shape[1] + 2)
+        open_memmap(os.path.join(path, PHEROMONES), mode="w+", dtype=pheromones.pheromon.dtype, shape=shape).flush()
+        open_memmap(os.path.join(path, ANTS), mode="w+", dtype=np.int64, shape=(sum(counts), colony.ANT_FIELDS)).flush()
+    comm.barrier()
+
+    if rank != 0:
+        field = np.load(os.path.join(path, PHEROMONES), mmap_mode="r+")
+        if ants.domain is not None:
+            field[1 + pheromones.row_start:1 + pheromones.row_end] = pheromones.pheromon[1:-1]
+        elif rank_new == 0:
+            field[:] = pheromones.pheromon
+        field.flush()
+
+        offset = sum(counts[:rank])
+        packed = np.load(os.path.join(path, ANTS), mmap_mode="r+")
+        packed[offset:offset + counts[rank]] = ants.pack_state()
+        packed.flush()
+    comm.barrier()
+
+    if rank == 0:
+        with open(os.path.join(path, HEADER), "w") as file:
+            json.dump(header, file, indent=2)
+    comm.barrier()
+
+
+def maps_file(array, path):
+    """
+    Whether an array is a memory map of the given file.
+    """
+    return isinstance(array, np.memmap) and os.path.exists(path) and os.path.samefile(array.filename, path)
+
+
+def read_header(path):
+    """
+    Reads the header of a checkpoint.
+
+    Returns:
+        dict: Step, food collected and parameters of the checkpointed run.
+    """
+    with open(os.path.join(path, HEADER)) as file:
+        return json.load(file)
+
+
+def load_maze_cells(path):
+    """
+    Maps the maze of a checkpoint in memory, without reading it.
+
+    Returns:
+        numpy.memmap: The exits of the cells of the maze, read-only.
+    """
+    return np.load(os.path.join(path, MAZE), mmap_mode="r")
+
+
+def restore_checkpoint(path, header, pheromones, ants):
+    """
+    Restores the pheromones and the ants of the current process from a checkpoint.
+
+    The ants are divided among the processes as when starting a run: by index, or by band of rows. As the random
+    numbers of the ants only depend on their index and the step, the run continues the same way whatever the number
+    of processes and the decomposition of the checkpointed run.
+
+    Args:
+        path (str): Directory of the checkpoint.
+        header (dict): Header of the checkpoint.
+        pheromones: The pheromones of the current process, overwritten.
+        ants: The colony of the current process, overwritten.
+    """
+    field = np.load(os.path.join(path, PHEROMONES), mmap_mode="r")
+    pheromones.pheromon[:] = field[pheromones.row_start:pheromones.row_end + 2]
+    pheromones.update_active_region()
+
+    packed = np.load(os.path.join(path, ANTS), mmap_mode="r")
+    if rank != 0 and ants.domain is not None:
+        packed = packed[ants.domain.get_owners(packed[:, 4]) == rank_new]
+    elif rank != 0:
+        packed = packed[np.logical_and(packed[:, 0] >= ants.min_index, packed[:, 0] < ants.max_index)]
+    ants.unpack_state(packed)
+    ants.step = header["step"]
@@ -1,11 +1,13 @@
 """
 Module managing an ant colony in a labyrinth.
 """
+import time
 import numpy as np
 import maze
 import direction as d
 import pygame as pg
 from mpi4py import MPI
+from counter_rng import random_numbers, random_floats
 from mpi_init import initialize_mpi
 
 # Initialize MPI communication
@@ -15,201 +17,456 @@ comm, rank, size, new_comm, comm_display, rank_new, size_new = initialize_mpi()
 UNLOADED, LOADED = False, True
 EXPLORATION_COEFFICIENT = 0.
 
+# Tags of the snapshots sent to rank 0 when the display is asynchronous
+TAG_SNAPSHOT_HEADER = 101
+TAG_SNAPSHOT_PHEROMONES = 102
+TAG_SNAPSHOT_ANTS = 103
+
+# Number of values describing an ant (see Colony.pack_state)
+ANT_FIELDS = 8
+
+
+def _build_exploration_moves():
+    """
+    Lists the directions an exploring ant may take, for each value of a cell of the maze and each direction the ant
+    is facing: all the exits of the cell but the one it comes from, unless it is a dead end.
+
+    Returns:
+        tuple: The number of possible directions, array of shape (16, 5), and the possible directions, array of
+            shape (16, 5, 4). The second axis is indexed by the direction faced, DIR_NONE being the last one.
+    """
+    counts = np.zeros((16, 5), dtype=np.int8)
+    moves = np.full((16, 5, 4), d.DIR_NONE, dtype=np.int8)
+    for value in range(16):
+        cell_exits = [direction for direction, flag in enumerate(maze.DIRECTION_FLAGS) if value & flag]
+        for facing in (d.DIR_NONE, d.DIR_NORTH, d.DIR_EAST, d.DIR_WEST, d.DIR_SOUTH):
+            possible = [direction for direction in cell_exits if direction != 3 - facing or len(cell_exits) == 1]
+            counts[value, facing] = len(possible)
+            moves[value, facing, :len(possible)] = possible
+    return counts, moves
+
+
+EXPLORATION_COUNTS, EXPLORATION_MOVES = _build_exploration_moves()
+
+# Phases of a step whose duration is measured (see Colony.timings)
+PHASES = ("return_to_nest", "explore", "migrate", "mark", "merge", "gather", "evaporation")
+
 
 class Colony:
-    def __init__(self, num_ants, initial_position, max_life, min_index, max_index):
+    def __init__(self, num_ants, nests, max_life, min_index, max_index, domain=None, synchronous_display=True,
+                 exploration_coefficient=EXPLORATION_COEFFICIENT):
         # Parameters
         self.min_index = min_index
         self.max_index = max_index
         self.sprites = []
 
+        # Probability for an unloaded ant to explore the maze even if pheromones could guide it
+        self.exploration_coefficient = exploration_coefficient
+
+        # Bands of rows of the maze owned by each process when the maze is decomposed, None when the ants are
+        # divided among the processes by index
+        self.domain = domain
+
+        # When the display is synchronous, every step ends by sending the state to draw to rank 0. Otherwise,
+        # rank 0 does not take part in the steps and receives snapshots (see post_snapshot).
+        self.synchronous_display = synchronous_display
+
+        # Buffers used to gather on rank 0 what is needed to draw the ants, allocated at the first gather
+        self.display_counts = None
+        self.display_state = None
+
+        # Two snapshot buffers with their pending send requests, used alternately by the computing processes
+        self.snapshots = [None, None]
+        self.snapshot_index = 0
+
+        # Time spent by the current process in each phase of the steps, in seconds
+        self.timings = dict.fromkeys(PHASES, 0.)
+
         # Initialize colony attributes
-        self._init_colony(num_ants, initial_position, max_life)
+        self._init_colony(num_ants, nests, max_life)
 
-    def _init_colony(self, num_ants, initial_position, max_life):
+    def _init_colony(self, num_ants, nests, max_life):
         # Initialize ant attributes
-        self._init_ant_attributes(num_ants, max_life, initial_position)
+        self._init_ant_attributes(num_ants, max_life, nests)
 
-        # Initialize ant sprites
-        self._init_ant_sprites()
+        # The ant sprites are only loaded by the process drawing them, at the first display
 
-    def _init_ant_attributes(self, num_ants, max_life, initial_position):
-        # Generate unique random seeds for each ant
-        self.seeds = np.arange(self.min_index + 1, self.max_index + 1, dtype=np.int64)
+    def _init_ant_attributes(self, num_ants, max_life, nests):
+        # Index of each ant in the whole colony, which identifies its random numbers
+        self.ids = np.arange(self.min_index, self.max_index, dtype=np.int64)
+
+        # Number of steps done, the other counter of the random numbers
+        self.step = 0
 
         # State of each ant: loaded or unloaded
         self.is_loaded = np.zeros(num_ants, dtype=np.int8)
 
+        # Food source of the food carried by each ant, -1 when it is unloaded
+        self.food_sources = np.full(num_ants, -1, dtype=np.int16)
+
         # Compute the maximal life amount for each ant
         self.max_life = max_life * np.ones(num_ants, dtype=np.int32)
-        self.max_life -= np.int32(max_life * (self.seeds / 2147483647.)) // 4
+        self.max_life -= np.int32(max_life * ((self.ids + 1) / 2147483647.)) // 4
 
         # Ages of ants: zero at the beginning
         self.age = np.zeros(num_ants, dtype=np.int64)
 
-        # History of the path taken by each ant
-        self.historic_path = np.zeros((num_ants, max_life + 1, 2), dtype=np.int16)
-        self.historic_path[:, 0, 0] = initial_position[0]
-        self.historic_path[:, 0, 1] = initial_position[1]
+        # Current position of each ant, starting in its nest (see get_home_nests). The path back to the nest is not
+        # stored: loaded ants follow the directions to the nearest nest given by the maze, which is their path
+        # without its loops when there is a single nest
+        self.positions = nests.positions[self.get_home_nests(self.ids, nests)]
 
         # Direction in which the ant is currently facing
         self.directions = d.DIR_NONE * np.ones(num_ants, dtype=np.int8)
 
     def _init_ant_sprites(self):
-        # Load ant sprites
+        # Load ant sprites (requires a display)
         img = pg.image.load("ants.png").convert_alpha()
         for i in range(0, 32, 8):
             self.sprites.append(pg.Surface.subsurface(img, i, 0, 8, 8))
 
-    def return_to_nest(self, loaded_ants, nest_position, food_counter):
+    @staticmethod
+    def get_home_nests(ids, nests):
+        """
+        Gives the nest where each ant starts, and starts again at the end of its life: the ants are dealt to the nests
+        by index.
+
+        Args:
+            ids: Indices of the ants in the whole colony.
+            nests: The nests of the maze.
+
+        Returns:
+            The number of the nest of each ant.
+        """
+        return ids % len(nests)
+
+    def return_to_nest(self, loaded_ants, the_maze, nests, food_counter):
         """
-        Return ants carrying food to their nests.
+        Return ants carrying food to the nearest nest.
+
+        Each loaded ant moves one cell along the shortest path to the nearest nest, given by the directions to the
+        nests computed once by the maze.
 
         Args:
             loaded_ants: Indices of ants carrying food.
-            nest_position: Position of the nest.
-            food_counter: Current quantity of food in the nest.
+            the_maze: The maze in which ants move.
+            nests: The nests of the maze.
+            food_counter: Array with the current quantity of food in the nests brought from each food source.
 
         Returns:
-            The updated quantity of food in the nest.
+            The updated quantity of food in the nests brought from each food source.
         """
         self.age[loaded_ants] -= 1
 
-        in_nest_tmp = self.historic_path[loaded_ants, self.age[loaded_ants], :] == nest_position
-        if in_nest_tmp.any():
-            in_nest_loc = np.nonzero(np.logical_and(in_nest_tmp[:, 0], in_nest_tmp[:, 1]))[0]
-            if in_nest_loc.shape[0] > 0:
-                in_nest = loaded_ants[in_nest_loc]
-                self.is_loaded[in_nest] = UNLOADED
-                self.age[in_nest] = 0
-                food_counter += in_nest_loc.shape[0]
+        pos_ants = self.positions[loaded_ants, :]
+        to_nest = the_maze.get_directions_to(nests.positions)[pos_ants[:, 0], pos_ants[:, 1]]
+        moving = to_nest != d.DIR_NONE
+        pos_ants[moving, 0] += np.array(d.ROW_OFFSETS, dtype=np.int16)[to_nest[moving]]
+        pos_ants[moving, 1] += np.array(d.COL_OFFSETS, dtype=np.int16)[to_nest[moving]]
+        self.positions[loaded_ants, :] = pos_ants
+
+        in_nest = loaded_ants[nests.get_ids(pos_ants) >= 0]
+        if in_nest.shape[0] > 0:
+            food_counter = food_counter + np.bincount(self.food_sources[in_nest], minlength=food_counter.shape[0])
+            self.is_loaded[in_nest] = UNLOADED
+            self.food_sources[in_nest] = -1
+            self.age[in_nest] = 0
 
         return food_counter
 
-    def advance(self, the_maze, food_position, nest_position, pheromones, food_counter=0):
-        # Rank 0 initialization
+    def gather_display_state(self, food_counter):
+        """
+        Gather on rank 0 what it needs to draw the ants: the position, direction and loaded flag of each ant,
+        and the food brought back to the nest.
+
+        Each computing rank first sends its number of ants (which changes at every step when the maze is decomposed,
+        as ants migrate between processes) and the food its ants brought back from each food source since the
+        previous gather, with a single small Gather. Then it packs the values of its ants in an int16 array of shape
+        (num_ants, 4) and rank 0 receives them with a single Gatherv, both sides using buffers allocated once, so the
+        amount of data sent per step only depends on the number of ants. On rank 0, positions, directions and
+        is_loaded become views of the received buffer.
+
+        Args:
+            food_counter: Array with the food brought back from each food source: on rank 0, until the previous
+                gather, and on the computing ranks, by their ants since the previous gather.
+
+        Returns:
+            On rank 0, the food brought back to the nests from each food source by all the ants. On the computing
+            ranks, zeros, the food they count from now on.
+        """
+        num_ants = 0 if rank == 0 else self.directions.shape[0]
+        header = np.empty(1 + food_counter.shape[0], dtype=np.int64)
+        header[0] = num_ants
+        header[1:] = 0 if rank == 0 else food_counter
+        headers = np.empty((size, header.shape[0]), dtype=np.int64) if rank == 0 else None
+        comm.Gather(header, headers, root=0)
+        if rank == 0:
+            food_counter = food_counter + headers[:, 1:].sum(axis=0)
+            self.display_counts = 4 * headers[:, 0]
+            if self.display_state is None:
+                self.display_state = np.empty((self.display_counts.sum() // 4, 4), dtype=np.int16)
+        else:
+            food_counter = np.zeros_like(food_counter)
+            if self.display_state is None or self.display_state.shape[0] != num_ants:
+                self.display_state = np.empty((num_ants, 4), dtype=np.int16)
+
         if rank == 0:
-            results_hist = []
-            results_seeds = []
-            results_is_loaded = []
-            results_max_life = []
-            results_age = []
-            results_directions = []
-
-        # Communication barrier
+            displacements = np.insert(np.cumsum(self.display_counts[:-1]), 0, 0)
+            comm.Gatherv(np.empty((0, 4), dtype=np.int16),
+                         [self.display_state, self.display_counts, displacements, MPI.SHORT], root=0)
+            self.positions = self.display_state[:, 0:2]
+            self.directions = self.display_state[:, 2]
+            self.is_loaded = self.display_state[:, 3]
+        else:
+            self.display_state[:, 0:2] = self.positions
+            self.display_state[:, 2] = self.directions
+            self.display_state[:, 3] = self.is_loaded
+            comm.Gatherv(self.display_state, None, root=0)
+        return food_counter
+
+    def post_snapshot(self, pheromones, step, food_counter, finished=False):
+        """
+        Send to rank 0 a snapshot of what it needs to draw, without waiting for it to be received.
+
+        The snapshot is copied in one of two buffers used alternately, so the simulation can go on while the
+        previous snapshot is still being sent. Every computing process sends a header (step, number of ants,
+        finished flag and food counter of each food source), its part of the pheromones (the whole field for the
+        first computing process when the ants are divided by index, its band otherwise) and the position, direction
+        and loaded flag of its ants.
+
+        Args:
+            pheromones: The pheromone map.
+            step: The step of the simulation.
+            food_counter: Array with the quantity of food brought back to the nests from each food source by the ants
+                of this process.
+            finished: True for the last snapshot of the simulation.
+        """
+        pheromones.complete_merge()
+        snapshot = self.snapshots[self.snapshot_index]
+        if snapshot is not None:
+            MPI.Request.Waitall(snapshot["requests"])
+        num_ants = self.directions.shape[0]
+        if snapshot is None or snapshot["ants"].shape[0] != num_ants:
+            has_pheromones = self.domain is not None or rank_new == 0
+            snapshot = {
+                "header": np.empty(3 + food_counter.shape[0], dtype=np.int64),
+                "pheromones": np.empty_like(pheromones.pheromon[1:-1] if has_pheromones else pheromones.pheromon[:0]),
+                "ants": np.empty((num_ants, 4), dtype=np.int16)
+            }
+            self.snapshots[self.snapshot_index] = snapshot
+
+        snapshot["header"][:3] = step, num_ants, finished
+        snapshot["header"][3:] = food_counter
+        if snapshot["pheromones"].shape[0] > 0:
+            snapshot["pheromones"][:] = pheromones.pheromon[1:-1]
+        snapshot["ants"][:, 0:2] = self.positions
+        snapshot["ants"][:, 2] = self.directions
+        snapshot["ants"][:, 3] = self.is_loaded
+        snapshot["requests"] = [comm.Isend(snapshot["header"], dest=0, tag=TAG_SNAPSHOT_HEADER),
+                                comm.Isend(snapshot["pheromones"], dest=0, tag=TAG_SNAPSHOT_PHEROMONES),
+                                comm.Isend(snapshot["ants"], dest=0, tag=TAG_SNAPSHOT_ANTS)]
+        self.snapshot_index = 1 - self.snapshot_index
+
+    def wait_snapshots(self):
+        """
+        Wait until the snapshots posted by the computing process have been sent.
+        """
+        for snapshot in self.snapshots:
+            if snapshot is not None:
+                MPI.Request.Waitall(snapshot["requests"])
+
+    def receive_snapshot(self, pheromones, num_food_sources):
+        """
+        Receive on rank 0 the snapshot posted by every computing process at the same step.
+
+        Args:
+            pheromones: The pheromone map of the whole maze, updated with the received pheromones.
+            num_food_sources: The number of food sources of the maze.
+
+        Returns:
+            The step of the snapshot, an array with the total quantity of food in the nests brought from each food
+            source, and True if it is the last snapshot.
+        """
+        if self.display_state is None:
+            self.display_state = np.empty((self.directions.shape[0], 4), dtype=np.int16)
+
+        header = np.empty(3 + num_food_sources, dtype=np.int64)
+        food_counter = np.zeros(num_food_sources, dtype=np.int64)
+        offset = 0
+        for source in range(1, size):
+            comm.Recv(header, source=source, tag=TAG_SNAPSHOT_HEADER)
+            if self.domain is not None:
+                rows = self.domain.row_starts[source - 1], self.domain.row_starts[source]
+            else:
+                rows = (0, pheromones.pheromon.shape[0] - 2) if source == 1 else (0, 0)
+            comm.Recv(pheromones.pheromon[1 + rows[0]:1 + rows[1]], source=source, tag=TAG_SNAPSHOT_PHEROMONES)
+            comm.Recv(self.display_state[offset:offset + header[1]], source=source, tag=TAG_SNAPSHOT_ANTS)
+            offset += header[1]
+            food_counter += header[3:]
+
+        self.positions = self.display_state[:, 0:2]
+        self.directions = self.display_state[:, 2]
+        self.is_loaded = self.display_state[:, 3]
+        return int(header[0]), food_counter, bool(header[2])
+
+    def pack_state(self):
+        """
+        Packs the state of the ants of the current process in a single array.
+
+        Returns:
+            numpy.ndarray: Array of int64 of shape (num_ants, ANT_FIELDS) with, for each ant, its index, loaded flag,
+                maximal life, age, row, column, direction and food source of its food.
+        """
+        packed = np.empty((self.directions.shape[0], ANT_FIELDS), dtype=np.int64)
+        packed[:, 0] = self.ids
+        packed[:, 1] = self.is_loaded
+        packed[:, 2] = self.max_life
+        packed[:, 3] = self.age
+        packed[:, 4:6] = self.positions
+        packed[:, 6] = self.directions
+        packed[:, 7] = self.food_sources
+        return packed
+
+    def unpack_state(self, packed):
+        """
+        Replaces the ants of the current process by the ones packed by pack_state.
+
+        Args:
+            packed (numpy.ndarray): Array of shape (num_ants, ANT_FIELDS) with the state of the ants.
+        """
+        self.ids = packed[:, 0].astype(np.int64)
+        self.is_loaded = packed[:, 1].astype(np.int8)
+        self.max_life = packed[:, 2].astype(np.int32)
+        self.age = packed[:, 3].astype(np.int64)
+        self.positions = packed[:, 4:6].astype(np.int16)
+        self.directions = packed[:, 6].astype(np.int8)
+        self.food_sources = packed[:, 7].astype(np.int16)
+
+    def migrate(self):
+        """
+        Send the ants which left the band of rows of the current process to the process owning their new cell.
+        """
+        self.unpack_state(self.domain.migrate(self.pack_state(), self.domain.get_owners(self.positions[:, 0])))
+
+    def add_time(self, phase, start):
+        """
+        Adds the time elapsed since start to the timing of a phase.
+
+        Args:
+            phase (str): Name of the phase, one of PHASES.
+            start (float): Time at which the phase started.
+
+        Returns:
+            float: The current time, start of the next phase.
+        """
+        end = time.time()
+        self.timings[phase] += end - start
+        return end
+
+    def advance(self, the_maze, food_sites, nests, pheromones, food_counter):
+        start = time.time()
+
+        # The computing processes only synchronize through the communications of the data they need: the merge of
+        # the pheromones, the migration of the ants and, when the display is synchronous, the gather for the display,
+        # which also brings the food counters to rank 0.
         if not new_comm == MPI.COMM_NULL:
             loaded_ants = np.nonzero(self.is_loaded == True)[0]
             unloaded_ants = np.nonzero(self.is_loaded == False)[0]
 
             # Return loaded ants to the nest
-            if food_counter is None:
-                food_counter = 0
             if loaded_ants.shape[0] > 0:
-                food_counter = self.return_to_nest(loaded_ants, nest_position, food_counter)
-            new_comm.barrier()
+                food_counter = self.return_to_nest(loaded_ants, the_maze, nests, food_counter)
+            start = self.add_time("return_to_nest", start)
 
-        # Reduce food counter across processes
-        food_counter = comm.reduce(food_counter, op=MPI.SUM, root=0)
+            # The merge of the marks of the previous step went on while the loaded ants were moving
+            pheromones.complete_merge()
+            start = self.add_time("merge", start)
 
-        # Exploration and pheromone update
-        if not new_comm == MPI.COMM_NULL:
+            # Exploration and pheromone update
             if unloaded_ants.shape[0] > 0:
-                self.explore(unloaded_ants, the_maze, food_position, nest_position, pheromones)
-            new_comm.barrier()
+                self.explore(unloaded_ants, the_maze, food_sites, nests, pheromones)
+            self.step += 1
+            start = self.add_time("explore", start)
+
+            # Ants are marking the pheromones of their new cell, owned by another process if they left the band
+            if self.domain is not None:
+                self.migrate()
+                start = self.add_time("migrate", start)
 
             # Update pheromones
-            old_pos_ants = self.historic_path[range(0, self.seeds.shape[0]), self.age[:], :]
-            has_north_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.NORTH) > 0
-            has_east_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.EAST) > 0
-            has_south_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.SOUTH) > 0
-            has_west_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.WEST) > 0
-
-            # Marking pheromones
-            old_pheromones = pheromones.pheromon.copy()
-            [pheromones.mark(self.historic_path[i, self.age[i], :],
-                             [has_north_exit[i], has_east_exit[i], has_west_exit[i], has_south_exit[i]],
-                             old_pheromones) for i in range(self.directions.shape[0])]
-            result = np.zeros_like(pheromones.pheromon)
-            new_comm.Allreduce(pheromones.pheromon, result, op=MPI.MAX)
-            pheromones.pheromon = result.copy()
+            has_exits = the_maze.has_exits[the_maze.get_cell_indices(self.positions)]
+
+            # Marking pheromones. When the ants are divided by index, the marks are made in a buffer of -1, so that
+            # the processes keep the marks of the cells marked by any of their ants, whatever the division. The
+            # marks are merged by a non-blocking reduction, completed when the pheromones are needed again.
+            if self.domain is None:
+                marks, merged = pheromones.mark_for_merge(self.positions, has_exits)
+                pheromones.merge_request = new_comm.Iallreduce(marks, merged, op=MPI.MAX)
+                start = self.add_time("mark", start)
+            else:
+                pheromones.mark_many(self.positions, has_exits, pheromones.pheromon)
+                start = self.add_time("mark", start)
+                self.domain.exchange_ghost_rows(pheromones.pheromon)
+                start = self.add_time("merge", start)
+
+        if not self.synchronous_display:
+            return food_counter
+
+        # Gather the state of the ants to draw and the food at rank 0, while the marks are merged
+        food_counter = self.gather_display_state(food_counter)
 
         # Broadcast updated pheromones
-        if not comm_display == MPI.COMM_NULL:
+        pheromones.complete_merge()
+        if self.domain is not None:
+            self.domain.gather(pheromones.pheromon)
+        elif not comm_display == MPI.COMM_NULL:
             pheromones.pheromon = comm_display.bcast(pheromones.pheromon, root=1)
-
-        # Send/receive data between processes
-        if rank != 0:
-            comm.send(self.seeds, dest=0, tag=rank * 1)
-            comm.send(self.is_loaded, dest=0, tag=rank * 2)
-            comm.send(self.max_life, dest=0, tag=rank * 3)
-            comm.send(self.age, dest=0, tag=rank * 4)
-            comm.send(self.historic_path, dest=0, tag=rank * 5)
-            comm.send(self.directions, dest=0, tag=rank * 6)
-
-        # Gather data at rank 0
-        if rank == 0:
-            for i in range(1, size):
-                results_seeds.append(comm.recv(source=i, tag=i * 1))
-                results_is_loaded.append(comm.recv(source=i, tag=i * 2))
-                results_max_life.append(comm.recv(source=i, tag=i * 3))
-                results_age.append(comm.recv(source=i, tag=i * 4))
-                results_hist.append(comm.recv(source=i, tag=i * 5))
-                results_directions.append(comm.recv(source=i, tag=i * 6))
-
-            # Concatenate received data
-            self.seeds = np.hstack(results_seeds)
-            self.is_loaded = np.hstack(results_is_loaded)
-            self.max_life = np.hstack(results_max_life)
-            self.age = np.hstack(results_age)
-            self.historic_path = np.vstack(results_hist)
-            self.directions = np.hstack(results_directions)
+        self.add_time("gather", start)
 
         return food_counter
 
-    def explore(self, unloaded_ants, the_maze, food_position, nest_position, pheromones):
+    def explore(self, unloaded_ants, the_maze, food_sites, nests, pheromones):
         """
         Manage unloaded ants exploring the maze.
 
         Args:
             unloaded_ants: Indices of ants that are not loaded.
             the_maze: The maze in which ants move.
-            food_position: Position of food in the maze.
-            nest_position: Position of the ants' nest in the maze.
+            food_sites: The food sources of the maze.
+            nests: The nests of the maze.
             pheromones: The pheromone map.
 
         Returns:
             None
         """
-        # Update random seeds for unloaded ants
-        self.seeds[unloaded_ants] = np.mod(16807 * self.seeds[unloaded_ants], 2147483647)
-        choices = self.seeds[:] / 2147483647.
+        # Draw the random choice of each ant for this step
+        choices = random_floats(self.ids, self.step, 0)
 
         # Calculate possible exits for each ant in the maze
-        old_pos_ants = self.historic_path[range(0, self.seeds.shape[0]), self.age[:], :]
-        has_north_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.NORTH) > 0
-        has_east_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.EAST) > 0
-        has_south_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.SOUTH) > 0
-        has_west_exit = np.bitwise_and(the_maze.maze[old_pos_ants[:, 0], old_pos_ants[:, 1]], maze.WEST) > 0
-
-        # Read neighboring pheromones
-        north_pos = np.copy(old_pos_ants)
-        north_pos[:, 1] += 1
-        north_pheromone = pheromones.pheromon[north_pos[:, 0], north_pos[:, 1]] * has_north_exit
+        old_pos_ants = self.positions.copy()
+        cells = the_maze.get_cell_indices(old_pos_ants[unloaded_ants])
+        has_exits = the_maze.has_exits[cells]
+
+        # Read neighboring pheromones of unloaded ants. The pheromone array may only store a band of rows
+        # of the maze, that loaded ants may have left while returning to the nest.
+        pher_pos_ants = old_pos_ants[unloaded_ants].astype(np.intp)
+        pher_pos_ants[:, 0] -= pheromones.row_start
+        north_pheromone = np.zeros(old_pos_ants.shape[0], dtype=pheromones.pheromon.dtype)
+        north_pheromone[unloaded_ants] = \
+            pheromones.pheromon[pher_pos_ants[:, 0], pher_pos_ants[:, 1] + 1] * has_exits[:, d.DIR_NORTH]
 
         # Similar calculations for east, south, and west
-        east_pos = np.copy(old_pos_ants)
-        east_pos[:, 0] += 1
-        east_pos[:, 1] += 2
-        east_pheromone = pheromones.pheromon[east_pos[:, 0], east_pos[:, 1]] * has_east_exit
+        east_pheromone = np.zeros_like(north_pheromone)
+        east_pheromone[unloaded_ants] = \
+            pheromones.pheromon[pher_pos_ants[:, 0] + 1, pher_pos_ants[:, 1] + 2] * has_exits[:, d.DIR_EAST]
 
-        south_pos = np.copy(old_pos_ants)
-        south_pos[:, 0] += 2
-        south_pos[:, 1] += 1
-        south_pheromone = pheromones.pheromon[south_pos[:, 0], south_pos[:, 1]] * has_south_exit
+        south_pheromone = np.zeros_like(north_pheromone)
+        south_pheromone[unloaded_ants] = \
+            pheromones.pheromon[pher_pos_ants[:, 0] + 2, pher_pos_ants[:, 1] + 1] * has_exits[:, d.DIR_SOUTH]
 
-        west_pos = np.copy(old_pos_ants)
-        west_pos[:, 0] += 1
-        west_pheromone = pheromones.pheromon[west_pos[:, 0], west_pos[:, 1]] * has_west_exit
+        west_pheromone = np.zeros_like(north_pheromone)
+        west_pheromone[unloaded_ants] = \
+            pheromones.pheromon[pher_pos_ants[:, 0] + 1, pher_pos_ants[:, 1]] * has_exits[:, d.DIR_WEST]
 
         max_pheromones = np.maximum(north_pheromone, east_pheromone)
         max_pheromones = np.maximum(max_pheromones, south_pheromone)
@@ -217,64 +474,32 @@ class Colony:
 
         # Ants explore the maze by choice or if no pheromone can guide them
         ind_exploring_ants = \
-            np.nonzero(np.logical_or(choices[unloaded_ants] <= EXPLORATION_COEFFICIENT, max_pheromones[unloaded_ants] == 0.))[
-                0]
+            np.nonzero(np.logical_or(choices[unloaded_ants] <= self.exploration_coefficient,
+                                     max_pheromones[unloaded_ants] == 0.))[0]
         if ind_exploring_ants.shape[0] > 0:
+            exits = the_maze.exits[cells[ind_exploring_ants]]
             ind_exploring_ants = unloaded_ants[ind_exploring_ants]
-            valid_moves = np.zeros(choices.shape[0], np.int8)
-            nb_exits = has_north_exit * np.ones(has_north_exit.shape) + has_east_exit * np.ones(has_east_exit.shape) + \
-                       has_south_exit * np.ones(has_south_exit.shape) + has_west_exit * np.ones(has_west_exit.shape)
-            while np.any(valid_moves[ind_exploring_ants] == 0):
-                ind_ants_to_move = ind_exploring_ants[valid_moves[ind_exploring_ants] == 0]
-                self.seeds[:] = np.mod(16807 * self.seeds[:], 2147483647)
-                dir = np.mod(self.seeds[ind_ants_to_move], 4)
-                old_pos = self.historic_path[ind_ants_to_move, self.age[ind_ants_to_move], :]
-                new_pos = np.copy(old_pos)
-                new_pos[:, 1] -= (
-                        np.logical_and(dir == d.DIR_WEST, has_west_exit[ind_ants_to_move])
-                        * np.ones(new_pos.shape[0], dtype=np.int16)
-                )
-
-                new_pos[:, 1] += (
-                        np.logical_and(dir == d.DIR_EAST, has_east_exit[ind_ants_to_move])
-                        * np.ones(new_pos.shape[0], dtype=np.int16)
-                )
-                new_pos[:, 0] -= (np.logical_and(
-                    dir == d.DIR_NORTH, has_north_exit[ind_ants_to_move])
-                                  * np.ones(new_pos.shape[0], dtype=np.int16)
-                                  )
-                new_pos[:, 0] += (np.logical_and(
-                    dir == d.DIR_SOUTH, has_south_exit[ind_ants_to_move])
-                                  * np.ones(new_pos.shape[0], dtype=np.int16)
-                                  )
-                valid_moves[ind_ants_to_move] = np.logical_or(new_pos[:, 0] != old_pos[:, 0],
-                                                              new_pos[:, 1] != old_pos[:, 1])
-                valid_moves[ind_ants_to_move] = np.logical_and(
-                    valid_moves[ind_ants_to_move],
-                    np.logical_or(dir != 3 - self.directions[ind_ants_to_move], nb_exits[ind_ants_to_move] == 1))
-                ind_valid_moves = ind_ants_to_move[np.nonzero(valid_moves[ind_ants_to_move])[0]]
-                self.historic_path[ind_valid_moves, self.age[ind_valid_moves] + 1, :] \
-                    = new_pos[valid_moves[ind_ants_to_move] == 1, :]
-                self.directions[ind_valid_moves] = dir[valid_moves[ind_ants_to_move] == 1]
-
-        ind_following_ants = np.nonzero(np.logical_and(choices[unloaded_ants] > EXPLORATION_COEFFICIENT,
+            # A single draw per ant, uniform among the directions it may take
+            facing = self.directions[ind_exploring_ants]
+            draws = random_numbers(self.ids[ind_exploring_ants], self.step, 1) % \
+                EXPLORATION_COUNTS[exits, facing].astype(np.uint64)
+            dir = EXPLORATION_MOVES[exits, facing, draws.astype(np.intp)]
+            self.positions[ind_exploring_ants, 0] += np.array(d.ROW_OFFSETS, dtype=np.int16)[dir]
+            self.positions[ind_exploring_ants, 1] += np.array(d.COL_OFFSETS, dtype=np.int16)[dir]
+            self.directions[ind_exploring_ants] = dir
+
+        ind_following_ants = np.nonzero(np.logical_and(choices[unloaded_ants] > self.exploration_coefficient,
                                                        max_pheromones[unloaded_ants] > 0.))[0]
         if ind_following_ants.shape[0] > 0:
             ind_following_ants = unloaded_ants[ind_following_ants]
-            self.historic_path[ind_following_ants, self.age[ind_following_ants] + 1, :] = \
-                self.historic_path[ind_following_ants, self.age[ind_following_ants], :]
             max_east = (east_pheromone[ind_following_ants] == max_pheromones[ind_following_ants])
-            self.historic_path[ind_following_ants, self.age[ind_following_ants] + 1, 1] += \
-                max_east * np.ones(ind_following_ants.shape[0], dtype=np.int16)
+            self.positions[ind_following_ants, 1] += max_east * np.ones(ind_following_ants.shape[0], dtype=np.int16)
             max_west = (west_pheromone[ind_following_ants] == max_pheromones[ind_following_ants])
-            self.historic_path[ind_following_ants, self.age[ind_following_ants] + 1, 1] -= \
-                max_west * np.ones(ind_following_ants.shape[0], dtype=np.int16)
+            self.positions[ind_following_ants, 1] -= max_west * np.ones(ind_following_ants.shape[0], dtype=np.int16)
             max_north = (north_pheromone[ind_following_ants] == max_pheromones[ind_following_ants])
-            self.historic_path[ind_following_ants, self.age[ind_following_ants] + 1, 0] -= max_north * np.ones(
-                ind_following_ants.shape[0], dtype=np.int16)
+            self.positions[ind_following_ants, 0] -= max_north * np.ones(ind_following_ants.shape[0], dtype=np.int16)
             max_south = (south_pheromone[ind_following_ants] == max_pheromones[ind_following_ants])
-            self.historic_path[ind_following_ants, self.age[ind_following_ants] + 1, 0] += max_south * np.ones(
-                ind_following_ants.shape[0], dtype=np.int16)
+            self.positions[ind_following_ants, 0] += max_south * np.ones(ind_following_ants.shape[0], dtype=np.int16)
 
         # Age ants not carrying food
         if unloaded_ants.shape[0] > 0:
@@ -284,19 +509,49 @@ class Colony:
         ind_dying_ants = np.nonzero(self.age == self.max_life)[0]
         if ind_dying_ants.shape[0] > 0:
             self.age[ind_dying_ants] = 0
-            self.historic_path[ind_dying_ants, 0, 0] = nest_position[0]
-            self.historic_path[ind_dying_ants, 0, 1] = nest_position[1]
+            self.positions[ind_dying_ants] = nests.positions[self.get_home_nests(self.ids[ind_dying_ants], nests)]
             self.directions[ind_dying_ants] = d.DIR_NONE
 
         # Update state for ants reaching food
-        ants_at_food_loc = \
-            np.nonzero(np.logical_and(self.historic_path[unloaded_ants, self.age[unloaded_ants], 0] == food_position[0],
-                                      self.historic_path[unloaded_ants, self.age[unloaded_ants], 1] == food_position[1]))[0]
+        sources = food_sites.get_ids(self.positions[unloaded_ants])
+        ants_at_food_loc = np.nonzero(sources >= 0)[0]
         if ants_at_food_loc.shape[0] > 0:
             ants_at_food = unloaded_ants[ants_at_food_loc]
             self.is_loaded[ants_at_food] = True
+            self.food_sources[ants_at_food] = sources[ants_at_food_loc]
+
+    def get_positions(self):
+        """
+        Get the current position of each ant.
+
+        Returns:
+            Array of shape (num_ants, 2) with the row and column of each ant.
+        """
+        return self.positions
 
     def display(self, screen):
-        [screen.blit(self.sprites[self.directions[i]],
-                     (8 * self.historic_path[i, self.age[i], 1], 8 * self.historic_path[i, self.age[i], 0])) for i in
-         range(self.directions.shape[0])]
+        """
+        Draw the ants on the screen.
+
+        Only one sprite is drawn per cell (the one of the last ant standing on it, as it used to be drawn on top),
+        and the sprites are drawn direction by direction with a single blits call each.
+
+        Args:
+            screen: The Pygame screen object.
+        """
+        positions = self.get_positions().astype(np.int64)
+        if positions.shape[0] == 0:
+            return
+        if not self.sprites:
+            self._init_ant_sprites()
+
+        # Keep the last ant on each cell
+        cells = positions[:, 0] * (np.max(positions[:, 1]) + 1) + positions[:, 1]
+        _, last = np.unique(cells[::-1], return_index=True)
+        ants = positions.shape[0] - 1 - last
+
+        # DIR_NONE (-1) uses the last sprite, as when indexing the list of sprites with the direction
+        sprite_ids = np.mod(self.directions[ants], len(self.sprites))
+        for sprite_id, sprite in enumerate(self.sprites):
+            group = ants[sprite_ids == sprite_id]
+            screen.blits([(sprite, (8 * j, 8 * i)) for i, j in positions[group].tolist()], doreturn=False)
@@ -0,0 +1,42 @@
+"""
+Counter-based random generator: the random numbers are hashes of their counters instead of the successive states of
+a generator, so they can be drawn in any order, by any process, and always give the same values.
+"""
+import numpy as np
+
+# Constants of splitmix64
+GOLDEN_GAMMA = 0x9E3779B97F4A7C15
+UINT64_MASK = 0xFFFFFFFFFFFFFFFF
+
+
+def _mix(x):
+    """
+    Scrambles the bits of unsigned 64-bit integers (finalizer of splitmix64).
+    """
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def random_numbers(keys, *counters):
+    """
+    Draws one random number per key, which only depends on the key and the counters.
+
+    Args:
+        keys (numpy.ndarray): Integers identifying the draws, for example the indices of the ants.
+        counters (int): Other integers identifying the draws, for example the step and the attempt.
+
+    Returns:
+        numpy.ndarray: Random unsigned 64-bit integers, one per key.
+    """
+    x = _mix(keys.astype(np.uint64) * np.uint64(GOLDEN_GAMMA) + np.uint64(GOLDEN_GAMMA))
+    for counter in counters:
+        x = _mix(x + np.uint64((counter * GOLDEN_GAMMA) & UINT64_MASK))
+    return x
+
+
+def random_floats(keys, *counters):
+    """
+    Draws one random number in [0, 1) per key, which only depends on the key and the counters.
+    """
+    return (random_numbers(keys, *counters) >> np.uint64(11)) * 2. ** -53
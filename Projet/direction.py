@@ -8,3 +8,7 @@ DIR_NORTH =  0
 DIR_EAST  =  1
 DIR_WEST  =  2
 DIR_SOUTH =  3
+
+# Row and column offsets of a move in each direction
+ROW_OFFSETS = (-1, 0, 0, 1)
+COL_OFFSETS = (0, 1, -1, 0)
@@ -0,0 +1,109 @@
+"""
+Spatial decomposition of the maze in bands of rows among the computing processes.
+"""
+from math import floor
+
+import numpy as np
+from mpi4py import MPI
+from mpi_init import initialize_mpi
+
+# Initialize MPI communication
+comm, rank, size, new_comm, comm_display, rank_new, size_new = initialize_mpi()
+
+
+class RowBands:
+    """
+    Splits the rows of the maze in one band of consecutive rows per computing process (every rank but 0).
+
+    Each computing process owns the pheromones and the ants of its band. It only exchanges the pheromones of its
+    first and last rows with its neighbours (the ghost rows), and sends the ants leaving its band to their new
+    owner, so the communication scales with the width of the maze instead of its area.
+    Rank 0 also builds this object, to know the bands it gathers for the display.
+    """
+
+    def __init__(self, dimensions):
+        """
+        Initializes the bands of rows.
+
+        Args:
+            dimensions (tuple): The dimensions of the maze.
+        """
+        nb_bands = size - 1
+        assert nb_bands <= dimensions[0], "There must be at most one computing process per row of the maze"
+        self.width = dimensions[1]
+        self.row_starts = np.array([floor(i * dimensions[0] / nb_bands) for i in range(nb_bands + 1)],
+                                   dtype=np.int64)
+
+        if rank_new is not None:
+            self.row_start, self.row_end = self.row_starts[rank_new], self.row_starts[rank_new + 1]
+            self.north = rank_new - 1 if rank_new > 0 else MPI.PROC_NULL
+            self.south = rank_new + 1 if rank_new < nb_bands - 1 else MPI.PROC_NULL
+        else:
+            self.row_start, self.row_end = 0, dimensions[0]
+
+    def get_rows(self):
+        """
+        Returns:
+            tuple: The first and last (excluded) rows of the band of the current process.
+        """
+        return int(self.row_start), int(self.row_end)
+
+    def get_owners(self, rows):
+        """
+        Get the band owning each of the given rows.
+
+        Args:
+            rows (numpy.ndarray): Rows of the maze.
+
+        Returns:
+            numpy.ndarray: The rank in the computing communicator of the owner of each row.
+        """
+        return np.searchsorted(self.row_starts, rows, side='right') - 1
+
+    def exchange_ghost_rows(self, field):
+        """
+        Sends the first and last rows of the band to the neighbouring bands and receives their rows in the ghost rows.
+
+        Args:
+            field (numpy.ndarray): Array storing the band with one ghost row above and below it.
+        """
+        new_comm.Sendrecv(field[1], dest=self.north, recvbuf=field[-1], source=self.south)
+        new_comm.Sendrecv(field[-2], dest=self.south, recvbuf=field[0], source=self.north)
+
+    def migrate(self, packed, owners):
+        """
+        Sends rows of an array to the process owning them, and receives the rows sent by the other processes.
+
+        Args:
+            packed (numpy.ndarray): Array of int64 of shape (n, k), one row per item to exchange.
+            owners (numpy.ndarray): The rank in the computing communicator of the new owner of each row.
+
+        Returns:
+            numpy.ndarray: The rows received from the other processes (and the rows kept by the current process).
+        """
+        order = np.argsort(owners, kind="stable")
+        send_counts = packed.shape[1] * np.bincount(owners, minlength=size_new)
+        recv_counts = np.empty_like(send_counts)
+        new_comm.Alltoall(send_counts, recv_counts)
+
+        received = np.empty((recv_counts.sum() // packed.shape[1], packed.shape[1]), dtype=np.int64)
+        send_displacements = np.insert(np.cumsum(send_counts[:-1]), 0, 0)
+        recv_displacements = np.insert(np.cumsum(recv_counts[:-1]), 0, 0)
+        new_comm.Alltoallv([np.ascontiguousarray(packed[order]), send_counts, send_displacements, MPI.INT64_T],
+                           [received, recv_counts, recv_displacements, MPI.INT64_T])
+        return received
+
+    def gather(self, field):
+        """
+        Gathers the bands of all the computing processes on rank 0, for the display.
+
+        Args:
+            field (numpy.ndarray): On the computing processes, the band with its ghost rows. On rank 0, the array
+                storing the whole maze with one row of padding above and below it, which receives the bands.
+        """
+        if rank == 0:
+            counts = np.insert(np.diff(self.row_starts), 0, 0) * field.shape[1]
+            displacements = np.insert(np.cumsum(counts[:-1]), 0, 0)
+            comm.Gatherv(np.empty(0, dtype=field.dtype), [field[1:-1], (counts, displacements)], root=0)
+        else:
+            comm.Gatherv(field[1:-1], None, root=0)
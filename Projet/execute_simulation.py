@@ -1,72 +1,253 @@
+"""
+Strong and weak scaling measurements of the ant colony simulation.
+
+Each run launches `main_mpi.py --headless` with mpiexec and reads the JSON line it prints at the end. The runs are
+repeated to compute the mean number of steps per second with its 95% confidence interval, from which the speedup
+and the efficiency are derived. The raw runs and the summary are written as CSV and JSON, with plots.
+
+Strong scaling keeps the maze and the number of ants fixed while the number of processes grows. Weak scaling keeps
+the work per computing process fixed: the maze given by --sizes is the part of one computing process, and its number
+of rows (as well as the number of ants, if given) is multiplied by the number of computing processes.
+Rank 0 only displays the simulation, so a run with p processes has p - 1 computing processes.
+"""
+import argparse
+import csv
+import json
+import os
+import shlex
 import subprocess
-import re
+import sys
+from math import sqrt
+
 import matplotlib.pyplot as plt
-import os
+
+# Two-sided 95% quantiles of the Student t distribution, by degrees of freedom (the normal one beyond)
+T_QUANTILES_95 = {1: 12.706, 2: 4.303, 3: 3.182, 4: 2.776, 5: 2.571, 6: 2.447, 7: 2.365, 8: 2.306, 9: 2.262,
+                  10: 2.228, 15: 2.131, 20: 2.086, 30: 2.042}
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Strong and weak scaling measurements of the ant colony simulation.")
+    parser.add_argument("scaling", choices=["strong", "weak"], help="kind of scaling to measure")
+    parser.add_argument("--processes", type=int, nargs="+", default=[2, 3, 4],
+                        help="numbers of MPI processes, rank 0 included")
+    parser.add_argument("--sizes", nargs="+", default=["25x25"],
+                        help="maze sizes as HEIGHTxWIDTH (per computing process for weak scaling)")
+    parser.add_argument("--ants", type=int, nargs="+", default=[None],
+                        help="numbers of ants (per computing process for weak scaling), "
+                             "by default one ant for four cells of the maze")
+    parser.add_argument("--decompositions", choices=["ants", "bands"], nargs="+", default=["ants"],
+                        help="decompositions of the simulation among the processes")
+    parser.add_argument("--steps", type=int, default=1000, help="number of simulation steps of each run")
+    parser.add_argument("--max-life", type=int, default=500, help="maximal life of an ant")
+    parser.add_argument("--alpha", type=float, default=0.9, help="evaporation rate of pheromones")
+    parser.add_argument("--beta", type=float, default=0.99, help="persistence rate of pheromones")
+    parser.add_argument("--repeats", type=int, default=5, help="number of runs of each configuration")
+    parser.add_argument("--timeout", type=float, default=600, help="maximal duration of a run in seconds")
+    parser.add_argument("--mpiexec", default="mpiexec", help="command launching the MPI processes")
+    parser.add_argument("--mpiexec-args", default="", help="additional arguments of the MPI launcher")
+    parser.add_argument("--output", default="results", help="directory receiving the results and the plots")
+    arguments = parser.parse_args()
+    arguments.sizes = [parse_size(size) for size in arguments.sizes]
+    if min(arguments.processes) < 2:
+        parser.error("at least 2 processes are needed, rank 0 only displays the simulation")
+    return arguments
+
+
+def parse_size(size):
+    """
+    Converts a maze size written HEIGHTxWIDTH to a tuple of integers.
+    """
+    height, width = size.lower().split("x")
+    return int(height), int(width)
+
+
+def get_configurations(arguments):
+    """
+    Lists the configurations to run.
+
+    Returns:
+        list: One dictionary per configuration, with the base maze size and number of ants of its series and the
+            actual ones of the run.
+    """
+    configurations = []
+    for decomposition in arguments.decompositions:
+        for base_height, base_width in arguments.sizes:
+            for base_ants in arguments.ants:
+                for num_processes in sorted(arguments.processes):
+                    factor = num_processes - 1 if arguments.scaling == "weak" else 1
+                    height = base_height * factor
+                    configurations.append({
+                        "scaling": arguments.scaling,
+                        "decomposition": decomposition,
+                        "base_height": base_height,
+                        "base_width": base_width,
+                        "base_ants": base_ants,
+                        "processes": num_processes,
+                        "height": height,
+                        "width": base_width,
+                        # Same default as the simulation, one ant for four cells of the maze
+                        "ants": height * base_width // 4 if base_ants is None else base_ants * factor,
+                    })
+    return configurations
 
 
-def execute_script(num_processes, timeout=60):
-    command = f"mpiexec -n {num_processes} python3 main_mpi.py"
-    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def execute_script(configuration, arguments):
+    """
+    Runs the simulation once in headless mode.
+
+    Returns:
+        dict: The metrics printed by the simulation, or None if the run failed or timed out.
+    """
+    command = [arguments.mpiexec, *shlex.split(arguments.mpiexec_args), "-n", str(configuration["processes"]),
+               sys.executable, "main_mpi.py", str(configuration["height"]), str(configuration["width"]),
+               str(arguments.max_life), str(arguments.alpha), str(arguments.beta), str(arguments.steps),
+               "--ants", str(configuration["ants"]), "--headless", "--decomposition", configuration["decomposition"]]
+
     try:
-        stdout, _ = process.communicate(timeout=timeout)
-        output = stdout.decode('utf-8')
-        print(f"Output for {num_processes} processes:")
-        print("Standard Output:", output)
-        # Match FPS mean values in the output
-        fps_mean_values = re.findall(r"FPS\s*mean:\s*(\d+\.\d+)", output, re.IGNORECASE)
-        return [float(value) for value in fps_mean_values]
+        process = subprocess.run(command, capture_output=True, text=True, timeout=arguments.timeout,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
     except subprocess.TimeoutExpired:
-        print(f"Execution with {num_processes} processes timed out.")
-        process.terminate()
+        print(f"Execution of {' '.join(command)} timed out.", file=sys.stderr)
         return None
+    if process.returncode != 0:
+        print(f"Execution of {' '.join(command)} failed:\n{process.stderr}", file=sys.stderr)
+        return None
+
+    # The metrics are the last line of the output, after the messages of the libraries
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    print(f"Execution of {' '.join(command)} did not report its metrics.", file=sys.stderr)
+    return None
+
+
+def confidence_interval(values):
+    """
+    Computes the mean of measurements and the half width of its 95% confidence interval.
+    """
+    mean = sum(values) / len(values)
+    if len(values) < 2:
+        return mean, 0.
+    variance = sum((value - mean) ** 2 for value in values) / (len(values) - 1)
+    degrees = len(values) - 1
+    quantile = T_QUANTILES_95[max(key for key in T_QUANTILES_95 if key <= degrees)] if degrees <= 30 else 1.96
+    return mean, quantile * sqrt(variance / len(values))
+
 
+def summarize(configurations, runs):
+    """
+    Computes the mean performance of each configuration, and the speedup and efficiency of each series.
 
-def calculate_speedup(processes, fps_means):
-    speedup = []
-    for i in range(len(processes)):
-        speedup.append(fps_means[0] / fps_means[i] * 100 if fps_means[i] != 0 else 0)  # Handle division by zero
-    return speedup
+    The reference of a series is its configuration with the fewest processes. For strong scaling, the speedup is
+    the ratio of the numbers of steps per second, and the efficiency divides it by the ratio of the numbers of
+    computing processes. For weak scaling, the efficiency is the ratio of the numbers of steps per second, as the
+    time of a step should not change, and the (scaled) speedup multiplies it by the ratio of computing processes.
+    """
+    summary = []
+    reference = {}
+    for configuration in configurations:
+        measures = [run for run in runs if all(run[key] == configuration[key] for key in configuration)]
+        if not measures:
+            continue
+        steps_per_second, steps_per_second_ci = confidence_interval([run["steps_per_second"] for run in measures])
+        series = tuple(configuration[key] for key in ("decomposition", "base_height", "base_width", "base_ants"))
+        reference.setdefault(series, (configuration["processes"], steps_per_second))
+        reference_processes, reference_steps_per_second = reference[series]
 
+        workers = (configuration["processes"] - 1) / (reference_processes - 1)
+        ratio = steps_per_second / reference_steps_per_second
+        speedup, efficiency = (ratio, ratio / workers) if configuration["scaling"] == "strong" \
+            else (ratio * workers, ratio)
+        summary.append({
+            **configuration,
+            "repeats": len(measures),
+            "steps_per_second": steps_per_second,
+            "steps_per_second_ci95": steps_per_second_ci,
+            "elapsed": sum(run["elapsed"] for run in measures) / len(measures),
+            "food": sum(run["food"] for run in measures) / len(measures),
+            "speedup": speedup,
+            "efficiency": efficiency,
+        })
+    return summary
 
-def plot_results(processes, fps_means, speedup):
-    plt.plot(processes, fps_means, marker='o', label='FPS Mean')
-    plt.plot(processes, speedup, marker='o', label='Speedup')
-    plt.title('FPS Mean and Speedup vs Number of Processes')
-    plt.xlabel('Number of Processes')
-    plt.ylabel('FPS Mean')
-    plt.grid(True)
 
-    # Save graph
-    os.makedirs("graphs", exist_ok=True)
-    plt.savefig("graphs/fps_vs_processes.png")
-    plt.show()
+def write_results(output, runs, summary):
+    """
+    Writes the runs and the summary as CSV and JSON files.
+    """
+    os.makedirs(output, exist_ok=True)
+    for name, rows in (("runs", runs), ("summary", summary)):
+        with open(os.path.join(output, f"{name}.json"), "w") as file:
+            json.dump(rows, file, indent=2)
+        if not rows:
+            continue
+        # The time of each phase gets its own column in the CSV file
+        flat_rows = [{key: value for key, value in row.items() if key != "phases"} |
+                     {f"phase_{phase}": time for phase, time in row.get("phases", {}).items()} for row in rows]
+        with open(os.path.join(output, f"{name}.csv"), "w", newline="") as file:
+            writer = csv.DictWriter(file, fieldnames=list(flat_rows[0]))
+            writer.writeheader()
+            writer.writerows(flat_rows)
 
 
-def generate_readme(processes, fps_means, speedup):
-    with open("README.md", "w") as readme:
-        readme.write("# Results\n")
-        readme.write("## FPS Mean and Speedup vs Number of Processes\n\n")
-        readme.write("| Number of Processes | FPS Mean | Speedup |\n")
-        readme.write("|---------------------|----------|---------|\n")
-        for i in range(len(processes)):
-            readme.write(f"| {processes[i]} | {fps_means[i]:.2f} | {speedup[i]:.2f} |\n")
+def plot_results(output, summary):
+    """
+    Plots the steps per second, the speedup and the efficiency of each series against the number of processes.
+    """
+    if not summary:
+        return
+    figure, (ax_steps, ax_speedup, ax_efficiency) = plt.subplots(1, 3, figsize=(18, 5))
+    series = {}
+    for row in summary:
+        label = f"{row['decomposition']}, {row['base_height']}x{row['base_width']}"
+        if row["base_ants"] is not None:
+            label += f", {row['base_ants']} ants"
+        series.setdefault(label, []).append(row)
+
+    for label, rows in series.items():
+        processes = [row["processes"] for row in rows]
+        ax_steps.errorbar(processes, [row["steps_per_second"] for row in rows],
+                          yerr=[row["steps_per_second_ci95"] for row in rows], marker='o', capsize=3, label=label)
+        ax_speedup.plot(processes, [row["speedup"] for row in rows], marker='o', label=label)
+        ax_efficiency.plot(processes, [row["efficiency"] for row in rows], marker='o', label=label)
+
+    processes = sorted({row["processes"] for row in summary})
+    ax_speedup.plot(processes, [(p - 1) / (processes[0] - 1) for p in processes], 'k--', label="Ideal")
+    ax_efficiency.axhline(1., color='k', linestyle='--', label="Ideal")
+
+    scaling = summary[0]["scaling"]
+    for ax, title in ((ax_steps, "Steps per second (95% CI)"), (ax_speedup, "Speedup"),
+                      (ax_efficiency, "Efficiency")):
+        ax.set_title(f"{title}, {scaling} scaling")
+        ax.set_xlabel("Number of Processes")
+        ax.grid(True)
+        ax.legend()
+
+    figure.tight_layout()
+    figure.savefig(os.path.join(output, f"{scaling}_scaling.png"))
+    plt.close(figure)
 
 
 if __name__ == "__main__":
-    num_processes_list = [2, 3, 4]
-    fps_means = []
-    for num_processes in num_processes_list:
-        fps_mean_values = execute_script(num_processes)
-        print(fps_mean_values)
-        if fps_mean_values is not None:
-            fps_mean = sum(fps_mean_values) / len(fps_mean_values) if len(
-                fps_mean_values) > 0 else 0  # Handle division by zero
-            fps_means.append(fps_mean)
-
-    speedup = calculate_speedup(num_processes_list, fps_means)
-
-    print("FPS Mean values:", fps_means)
-    print("Speedup values:", speedup)
-
-    plot_results(num_processes_list, fps_means, speedup)
-    generate_readme(num_processes_list, fps_means, speedup)
+    arguments = parse_arguments()
+    configurations = get_configurations(arguments)
+
+    runs = []
+    for configuration in configurations:
+        for repeat in range(arguments.repeats):
+            metrics = execute_script(configuration, arguments)
+            if metrics is None:
+                continue
+            runs.append({**configuration, "repeat": repeat, "steps_per_second": metrics["steps_per_second"],
+                         "elapsed": metrics["elapsed"], "food": metrics["food"], "phases": metrics["phases"]})
+            print(f"{configuration['decomposition']}, {configuration['height']}x{configuration['width']}, "
+                  f"{configuration['ants']} ants, {configuration['processes']} processes, run {repeat + 1}: "
+                  f"{metrics['steps_per_second']:.2f} steps/s")
+
+    summary = summarize(configurations, runs)
+    write_results(arguments.output, runs, summary)
+    plot_results(arguments.output, summary)
@@ -1,107 +1,406 @@
 import maze
+import params
 import pheromone
+import numpy as np
 import pygame as pg
 from math import floor
 import colony
-import sys
+import checkpoint
+import domain
+import argparse
+import json
 import time
+from mpi4py import MPI
 from mpi_init import initialize_mpi
 
 # Initialize MPI communication
 comm, rank, size, new_comm, comm_display, rank_new, size_new = initialize_mpi()
 
+# Commands sent by rank 0 to the computing processes when the display is asynchronous
+TAG_COMMAND = 100
+COMMAND_NONE, COMMAND_FRAME, COMMAND_STOP = 0, 1, 2
 
-def initialize_screen():
+
+def parse_position(position):
+    """
+    Converts a position written ROW,COLUMN to a tuple of integers.
+    """
+    row, col = position.split(",")
+    return int(row), int(col)
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Simulation of an ant colony looking for food in a maze.")
+    parser.add_argument("height", nargs="?", type=int, default=25, help="number of rows of the maze")
+    parser.add_argument("width", nargs="?", type=int, default=25, help="number of columns of the maze")
+    parser.add_argument("max_life", nargs="?", type=int, default=500, help="maximal life of an ant")
+    parser.add_argument("alpha", nargs="?", type=float, default=0.9, help="evaporation rate of pheromones")
+    parser.add_argument("beta", nargs="?", type=float, default=0.99, help="persistence rate of pheromones")
+    parser.add_argument("max_iterations", nargs="?", type=int, default=5000, help="number of simulation steps")
+    parser.add_argument("--ants", type=int, default=None,
+                        help="number of ants (by default, one ant for four cells of the maze)")
+    parser.add_argument("--food-sources", type=parse_position, nargs="+", metavar="ROW,COLUMN",
+                        help="positions of the food sources (by default, a single one in the bottom right corner)")
+    parser.add_argument("--nests", type=parse_position, nargs="+", metavar="ROW,COLUMN",
+                        help="positions of the nests (by default, a single one in the top left corner). The ants are "
+                             "dealt to the nests by index, and bring the food back to the nearest one")
+    parser.add_argument("--exploration", type=float, default=colony.EXPLORATION_COEFFICIENT, metavar="PROBABILITY",
+                        help="probability for an ant to explore the maze even if pheromones could guide it")
+    parser.add_argument("--maze", choices=["dfs", "sidewinder"], default="dfs",
+                        help="algorithm generating the maze: randomized depth-first search (dfs), or the sidewinder "
+                             "algorithm (much faster on large mazes, each process generating a band of rows)")
+    parser.add_argument("--maze-file", metavar="PATH",
+                        help="map the maze saved in the .npy file PATH instead of generating it, for example a maze "
+                             "shared in memory by several runs")
+    parser.add_argument("--decomposition", choices=["ants", "bands"], default="ants",
+                        help="divide the ants among the processes by index (ants), "
+                             "or the rows of the maze with their pheromones and ants (bands)")
+    parser.add_argument("--display", choices=["sync", "async"], default="sync",
+                        help="draw every step of the simulation (sync), or let the simulation run ahead "
+                             "and draw its latest snapshot at the frame rate of the display (async)")
+    parser.add_argument("--headless", action="store_true",
+                        help="run max_iterations steps without any display, then print the number of steps per "
+                             "second, the time spent in each phase of the steps and the food collected as JSON")
+    parser.add_argument("--evaporation-threshold", type=float, default=0., metavar="LEVEL",
+                        help="set to zero the pheromone levels falling below LEVEL by evaporation, so that the "
+                             "evaporation only handles the region reached by the ants (by default, none)")
+    parser.add_argument("--pheromones", choices=list(pheromone.PHEROMONE_DTYPES), default="float64",
+                        help="type of the pheromone levels: smaller types reduce the memory and the communications "
+                             "of the pheromones, at the price of their precision")
+    parser.add_argument("--validate", action="store_true",
+                        help="with --headless, run the simulation again with float64 pheromones and report the "
+                             "divergence of the food collected")
+    parser.add_argument("--food-history", type=int, metavar="STEPS",
+                        help="with --headless, also report the food collected every STEPS steps")
+    parser.add_argument("--checkpoint", metavar="PATH",
+                        help="directory where the state of the simulation is saved at the end of the run")
+    parser.add_argument("--checkpoint-every", type=int, metavar="STEPS",
+                        help="also save the state of the simulation in the checkpoint every STEPS steps")
+    parser.add_argument("--restore", metavar="PATH",
+                        help="resume the simulation saved in the checkpoint PATH up to max_iterations steps, with "
+                             "the maze, number of ants and parameters of the saved run")
+    arguments = parser.parse_args()
+    if arguments.headless and arguments.display == "async":
+        parser.error("--headless runs without display, it cannot be used with --display async")
+    if arguments.checkpoint is not None and arguments.display == "async":
+        parser.error("--checkpoint is only available with --display sync")
+    if arguments.validate and (not arguments.headless or arguments.restore is not None):
+        parser.error("--validate is only available with --headless, without --restore")
+    if arguments.food_history is not None and not arguments.headless:
+        parser.error("--food-history is only available with --headless")
+    if arguments.maze_file is not None and arguments.restore is not None:
+        parser.error("--maze-file cannot be used with --restore, which uses the maze of the checkpoint")
+
+    # The saved run fixes the maze and the parameters of the simulation
+    arguments.header = None
+    if arguments.restore is not None:
+        arguments.header = checkpoint.read_header(arguments.restore)
+        for parameter in ("height", "width", "max_life", "alpha", "beta", "exploration", "ants", "maze", "pheromones"):
+            setattr(arguments, parameter, arguments.header[parameter])
+        arguments.food_sources = [tuple(position) for position in arguments.header["food_sources"]]
+        arguments.nests = [tuple(position) for position in arguments.header["nests"]]
+
+    if arguments.maze_file is not None and \
+            np.load(arguments.maze_file, mmap_mode="r").shape != (arguments.height, arguments.width):
+        parser.error("the maze of --maze-file must have the given height and width")
+
+    if arguments.food_sources is None:
+        arguments.food_sources = params.get_pos_food((arguments.height, arguments.width))
+    if arguments.nests is None:
+        arguments.nests = params.get_pos_nest()
+    sites = arguments.food_sources + arguments.nests
+    if any(not (0 <= row < arguments.height and 0 <= col < arguments.width) for row, col in sites):
+        parser.error("the food sources and the nests must be in the maze")
+    if len(set(sites)) < len(sites):
+        parser.error("the food sources and the nests must be in distinct cells")
+    return arguments
+
+
+def initialize_screen(arguments):
     """
     Initializes the Pygame screen.
+
+    Only rank 0 draws the simulation, so it is the only one with a screen, and none in headless mode.
     """
-    pg.init()
-    size_laby = (25, 25)
-    if len(sys.argv) > 2:
-        size_laby = (int(sys.argv[1]), int(sys.argv[2]))
+    size_laby = (arguments.height, arguments.width)
     resolution = size_laby[1] * 8, size_laby[0] * 8
-    if rank == 0:
+    screen = None
+    if rank == 0 and not arguments.headless:
+        pg.init()
         screen = pg.display.set_mode(resolution)
-    if rank != 0:
-        screen = pg.display.set_mode((0, 0), pg.HIDDEN | pg.NOFRAME | pg.HWSURFACE | pg.DOUBLEBUF)
     return screen, size_laby
 
 
-def initialize_parameters():
+def initialize_parameters(arguments):
     """
     Initializes parameters such as number of ants, max life, etc.
     """
-    nb_ants = size_laby[0] * size_laby[1] // 4
-    max_life = 500
-    if len(sys.argv) > 3:
-        max_life = int(sys.argv[3])
-    pos_food = size_laby[0] - 1, size_laby[1] - 1
-    pos_nest = 0, 0
-    alpha = 0.9
-    beta = 0.99
-    max_iterations = 5000  # Default value
-    if len(sys.argv) > 4:
-        alpha = float(sys.argv[4])
-    if len(sys.argv) > 5:
-        beta = float(sys.argv[5])
-    if len(sys.argv) > 6:
-        max_iterations = int(sys.argv[6])
-    return nb_ants, max_life, pos_food, pos_nest, alpha, beta, max_iterations
-
-
-def divide_ants_among_processes(nb_ants, max_life, pos_nest):
+    nb_ants = size_laby[0] * size_laby[1] // 4 if arguments.ants is None else arguments.ants
+    food_sites = maze.Sites(size_laby, arguments.food_sources)
+    nests = maze.Sites(size_laby, arguments.nests)
+    return nb_ants, arguments.max_life, food_sites, nests, arguments.alpha, arguments.beta, arguments.max_iterations
+
+
+def divide_ants_among_processes(nb_ants, max_life, nests, bands=None, synchronous_display=True,
+                                exploration_coefficient=colony.EXPLORATION_COEFFICIENT):
     """
     Divides ants among processes.
+
+    When the maze is decomposed in bands of rows, all the ants start in their nest, so each process keeps the ants
+    of the nests in its band.
     """
-    if rank == 0:
-        ants = colony.Colony(nb_ants, pos_nest, max_life, 0, nb_ants)
-    if rank != 0:
+    if rank == 0 or bands is not None:
+        ants = colony.Colony(nb_ants, nests, max_life, 0, nb_ants, bands, synchronous_display,
+                             exploration_coefficient)
+    if rank != 0 and bands is not None:
+        packed = ants.pack_state()
+        ants.unpack_state(packed[bands.get_owners(packed[:, 4]) == rank_new])
+    elif rank != 0:
         index_min = floor(rank_new * nb_ants / size_new)
         index_max = floor((rank_new + 1) * nb_ants / size_new)
-        ants = colony.Colony(index_max - index_min, pos_nest, max_life, index_min, index_max)
+        ants = colony.Colony(index_max - index_min, nests, max_life, index_min, index_max, None,
+                             synchronous_display, exploration_coefficient)
     return ants
 
 
-if __name__ == "__main__":
-    screen, size_laby = initialize_screen()
-    nb_ants, max_life, pos_food, pos_nest, alpha, beta, max_iterations = initialize_parameters()
-    ants = divide_ants_among_processes(nb_ants, max_life, pos_nest)
-    a_maze = maze.Maze(size_laby, 12345)
-    pherom = pheromone.Pheromon(size_laby, pos_food, alpha, beta)
+def run_asynchronous_display(screen, ants, a_maze, pherom, food_sites):
+    """
+    Draws the snapshots of the simulation on rank 0, at the frame rate of the display.
 
-    # Main loop
-    food_counter = 0
-    fps_counter = 0
-    fps_mean = 0
-    iteration = 0  # Initialize iteration count
-    finish = False
+    Rank 0 asks for a new snapshot once the previous one is drawn, so there is only one request pending at a
+    time, and the computing processes answer it at the end of their current step.
+    """
+    comm.send(COMMAND_FRAME, dest=1, tag=TAG_COMMAND)
+    last_step, last_time = 0, time.time()
+    while True:
+        step, food_counter, finished = ants.receive_snapshot(pherom, len(food_sites))
 
-    while not finish and iteration < max_iterations:  # Stop loop when reaching max_iterations
-        # Handle events
+        finish = False
         for event in pg.event.get():
             if event.type == pg.QUIT:
-                pg.quit()
                 finish = True
 
-        # Broadcast finish flag to all processes
-        finish = comm.bcast(finish, root=0)
-        if finish:
-            exit(0)
-
         # Display environment
         pherom.display(screen)
         screen.blit(a_maze.display(), (0, 0))
         ants.display(screen)
         pg.display.update()
 
+        current_time = time.time()
+        elapsed = current_time - last_time
+        print(f"FPS: {1. / elapsed:10.2f}, steps/s: {(step - last_step) / elapsed:10.2f}, step: {step}, "
+              f"nourriture : {food_counter.sum()}", end='\r')
+        last_step, last_time = step, current_time
+
+        if finished:
+            break
+        comm.send(COMMAND_STOP if finish else COMMAND_FRAME, dest=1, tag=TAG_COMMAND)
+        if finish:
+            break
+    pg.quit()
+
+
+def run_asynchronous_simulation(ants, a_maze, pherom, food_sites, nests, first_step, max_iterations, food_counter):
+    """
+    Runs the simulation on the computing processes without waiting for the display.
+
+    At the end of each step, the first computing process checks without blocking whether rank 0 sent a command,
+    and shares it with the other computing processes. They answer a frame request by posting a snapshot.
+    """
+    command = COMMAND_NONE
+    for iteration in range(first_step, max_iterations):
+        command = COMMAND_NONE
+        if rank_new == 0 and comm.Iprobe(source=0, tag=TAG_COMMAND):
+            command = comm.recv(source=0, tag=TAG_COMMAND)
+        command = new_comm.bcast(command, root=0)
+        if command == COMMAND_STOP:
+            break
+
+        food_counter = ants.advance(a_maze, food_sites, nests, pherom, food_counter)
+        pherom.do_evaporation(food_sites.positions)
+
+        if command == COMMAND_FRAME:
+            ants.post_snapshot(pherom, iteration + 1, food_counter)
+
+    # Answer the request of rank 0 still pending with the final state
+    if command != COMMAND_STOP:
+        command = comm.recv(source=0, tag=TAG_COMMAND) if rank_new == 0 else None
+        command = new_comm.bcast(command, root=0)
+        if command == COMMAND_FRAME:
+            ants.post_snapshot(pherom, max_iterations, food_counter, finished=True)
+    # The merge of the last step may still be in progress: MPI cannot be finalized with a pending collective
+    pherom.complete_merge()
+    ants.wait_snapshots()
+
+
+def get_checkpoint_header(arguments, nb_ants, step, food_counter):
+    """
+    Describes the current state of the run, for its checkpoint.
+    """
+    return {"step": step, "food": food_counter.tolist(), "height": arguments.height, "width": arguments.width,
+            "max_life": arguments.max_life, "alpha": arguments.alpha, "beta": arguments.beta,
+            "exploration": arguments.exploration, "ants": nb_ants,
+            "maze": arguments.maze, "pheromones": arguments.pheromones, "food_sources": arguments.food_sources,
+            "nests": arguments.nests}
+
+
+def run_baseline(arguments, nb_ants, max_life, food_sites, nests, bands, a_maze, max_iterations):
+    """
+    Runs the simulation from the start with float64 pheromones, to validate a run with another type of pheromones.
+
+    Returns:
+        numpy.ndarray: The food collected from each food source, on rank 0.
+    """
+    ants = divide_ants_among_processes(nb_ants, max_life, nests, bands, exploration_coefficient=arguments.exploration)
+    pherom = pheromone.Pheromon(size_laby, food_sites.positions, arguments.alpha, arguments.beta,
+                                None if bands is None else bands.get_rows(), arguments.evaporation_threshold)
+    food_counter = np.zeros(len(food_sites), dtype=np.int64)
+    for iteration in range(max_iterations):
+        food_counter = ants.advance(a_maze, food_sites, nests, pherom, food_counter)
+        pherom.do_evaporation(food_sites.positions)
+    return food_counter
+
+
+def report_headless_run(arguments, ants, nb_ants, steps, food_counter, elapsed, first_food, food_history,
+                        baseline_food=None):
+    """
+    Prints on rank 0 the performance of a headless run as a JSON line.
+
+    The time of a phase is the largest time spent in it by a process, since the processes wait for the slowest one.
+    The food collected is reported in total and for each food source, with the step and the time (since the start
+    of the run) at which the first food was brought back, None if it was not during the run. When requested, the
+    food collected every --food-history steps is also reported. When the run was validated, the food collected
+    with float64 pheromones and the divergence are also reported.
+    """
+    all_timings = comm.gather(ants.timings, root=0)
+    elapsed = comm.reduce(elapsed, op=MPI.MAX, root=0)
+    if rank == 0:
+        phases = {phase: max(timings[phase] for timings in all_timings) for phase in all_timings[0]}
+        report = {
+            "processes": size,
+            "decomposition": arguments.decomposition,
+            "maze": arguments.maze,
+            "height": arguments.height,
+            "width": arguments.width,
+            "ants": nb_ants,
+            "steps": steps,
+            "elapsed": elapsed,
+            "steps_per_second": steps / elapsed,
+            "pheromones": arguments.pheromones,
+            "food": int(food_counter.sum()),
+            "food_per_source": food_counter.tolist(),
+            "first_food_step": None if first_food is None else first_food[0],
+            "first_food_time": None if first_food is None else first_food[1],
+            "phases": phases,
+        }
+        if arguments.food_history is not None:
+            report["food_history_every"] = arguments.food_history
+            report["food_history"] = food_history
+        if baseline_food is not None:
+            food, baseline_food = int(food_counter.sum()), int(baseline_food.sum())
+            report["validation"] = {
+                "baseline_food": baseline_food,
+                "food_divergence": food - baseline_food,
+                "relative_food_divergence": (food - baseline_food) / baseline_food if baseline_food else None,
+            }
+        print(json.dumps(report))
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    screen, size_laby = initialize_screen(arguments)
+    nb_ants, max_life, food_sites, nests, alpha, beta, max_iterations = initialize_parameters(arguments)
+    bands = domain.RowBands(size_laby) if arguments.decomposition == "bands" else None
+    ants = divide_ants_among_processes(nb_ants, max_life, nests, bands, arguments.display == "sync",
+                                       arguments.exploration)
+
+    # The maze of a checkpoint, or a maze shared by several runs, is mapped in memory instead of being generated
+    cells = None
+    if arguments.restore is not None:
+        cells = checkpoint.load_maze_cells(arguments.restore)
+    elif arguments.maze_file is not None:
+        cells = np.load(arguments.maze_file, mmap_mode="r")
+    a_maze = maze.Maze(size_laby, 12345, arguments.maze, comm, cells)
+    pherom = pheromone.Pheromon(size_laby, food_sites.positions, alpha, beta,
+                                None if bands is None else bands.get_rows(), arguments.evaporation_threshold,
+                                arguments.pheromones)
+
+    # The food collected is counted by rank 0, or by the first computing process when the display is asynchronous
+    first_step, food_counter = 0, np.zeros(len(food_sites), dtype=np.int64)
+    if arguments.restore is not None:
+        checkpoint.restore_checkpoint(arguments.restore, arguments.header, pherom, ants)
+        first_step = arguments.header["step"]
+        if rank == (0 if arguments.display == "sync" else 1):
+            food_counter = np.array(arguments.header["food"], dtype=np.int64)
+
+    if arguments.display == "async":
+        if rank == 0:
+            run_asynchronous_display(screen, ants, a_maze, pherom, food_sites)
+        else:
+            run_asynchronous_simulation(ants, a_maze, pherom, food_sites, nests, first_step, max_iterations,
+                                        food_counter)
+        exit(0)
+
+    # Main loop
+    fps_counter = 0
+    fps_mean = 0
+    iteration = first_step  # Initialize iteration count
+    finish = False
+    # Step and time of the first food brought back, and food brought back every --food-history steps, on rank 0
+    first_food, food_history = None, []
+    has_food = food_counter.sum() > 0
+    comm.barrier()
+    start = time.time()
+
+    while not finish and iteration < max_iterations:  # Stop loop when reaching max_iterations
+        if not arguments.headless:
+            # Handle events
+            if rank == 0:
+                for event in pg.event.get():
+                    if event.type == pg.QUIT:
+                        pg.quit()
+                        finish = True
+
+            # Broadcast finish flag to all processes
+            finish = comm.bcast(finish, root=0)
+            if finish:
+                exit(0)
+
+            # Display environment
+            if rank == 0:
+                pherom.display(screen)
+                screen.blit(a_maze.display(), (0, 0))
+                ants.display(screen)
+                pg.display.update()
+
         # Time measurement
         deb = time.time()
 
         # Divide work between processes
-        food_counter = ants.advance(a_maze, pos_food, pos_nest, pherom, food_counter)
-        pherom.do_evaporation(pos_food)
+        food_counter = ants.advance(a_maze, food_sites, nests, pherom, food_counter)
+        evaporation_start = time.time()
+        pherom.do_evaporation(food_sites.positions)
 
-        end = time.time()
+        end = ants.add_time("evaporation", evaporation_start)
+        iteration += 1  # Increment iteration count
+
+        if arguments.headless and rank == 0:
+            if not has_food and food_counter.sum() > 0:
+                has_food = True
+                first_food = iteration, end - start
+            if arguments.food_history is not None and iteration % arguments.food_history == 0:
+                food_history.append(int(food_counter.sum()))
+
+        if arguments.checkpoint is not None and (iteration == max_iterations or (
+                arguments.checkpoint_every is not None and iteration % arguments.checkpoint_every == 0)):
+            checkpoint.save_checkpoint(arguments.checkpoint, get_checkpoint_header(arguments, nb_ants, iteration,
+                                                                                   food_counter), a_maze, pherom, ants)
+
+        if arguments.headless:
+            continue
 
         # Update FPS mean
         fps_counter += 1
@@ -109,6 +408,13 @@ if __name__ == "__main__":
         if fps_counter == 100:
             fps_counter = 1
             fps_mean = 0
-        print(f"FPS mean: {fps_mean / fps_counter:10.2f}, FPS counter: {fps_counter}, nourriture : {food_counter}", end='\r')
+        print(f"FPS mean: {fps_mean / fps_counter:10.2f}, FPS counter: {fps_counter}, "
+              f"nourriture : {food_counter.sum()}", end='\r')
 
-        iteration += 1  # Increment iteration count
+    if arguments.headless:
+        elapsed = time.time() - start
+        baseline_food = None
+        if arguments.validate:
+            baseline_food = run_baseline(arguments, nb_ants, max_life, food_sites, nests, bands, a_maze, max_iterations)
+        report_headless_run(arguments, ants, nb_ants, iteration - first_step, food_counter, elapsed, first_food,
+                            food_history, baseline_food)
@@ -4,12 +4,115 @@ Creates a two-dimensional maze where each cell in the maze is defined by the sum
 """
 import numpy as np
 import pygame as pg
+from scipy import sparse
+from scipy.sparse import csgraph
+import direction as d
+from counter_rng import random_numbers
 
 NORTH = 1
 EAST = 2
 SOUTH = 4
 WEST = 8
 
+# Exit flag of each direction, indexed by the direction constants
+DIRECTION_FLAGS = (NORTH, EAST, WEST, SOUTH)
+
+
+def generate_depth_first(dimensions, seed):
+    """
+    Generates a maze by a randomized depth-first search starting from the central cell.
+
+    The cells are handled by their linear index in flat Python lists, so nothing is allocated per visited cell.
+
+    Inputs:
+        dimensions: Tuple containing the height and the width of the maze.
+        seed: The seed of the Park-Miller generator choosing the next cell. The same seed produces the same maze.
+
+    Returns:
+        An array of int8 of the dimensions of the maze with the exits of each cell.
+    """
+    height, width = dimensions
+    cells = [0] * (height * width)
+    is_visited = bytearray(height * width)
+
+    # We choose the central cell as the initial cell.
+    historic = [(height // 2) * width + width // 2]
+
+    while historic:
+        cur_ind = historic[-1]
+        is_visited[cur_ind] = 1
+        row, col = divmod(cur_ind, width)
+
+        # Unvisited neighbouring cells, with the exits linking the current cell to them
+        neighbours = []
+        if col > 0 and not is_visited[cur_ind - 1]:  # West cell not visited
+            neighbours.append((cur_ind - 1, WEST, EAST))
+        if col < width - 1 and not is_visited[cur_ind + 1]:  # East cell
+            neighbours.append((cur_ind + 1, EAST, WEST))
+        if row < height - 1 and not is_visited[cur_ind + width]:  # South cell
+            neighbours.append((cur_ind + width, SOUTH, NORTH))
+        if row > 0 and not is_visited[cur_ind - width]:  # North cell
+            neighbours.append((cur_ind - width, NORTH, SOUTH))
+
+        if neighbours:
+            seed = (16807 * seed) % 2147483647
+            neighbour, exit, entry = neighbours[seed % len(neighbours)]
+            cells[cur_ind] |= exit
+            cells[neighbour] |= entry
+            historic.append(neighbour)
+        else:
+            historic.pop()
+
+    return np.array(cells, dtype=np.int8).reshape(dimensions)
+
+
+def generate_sidewinder(dimensions, seed, rows=None):
+    """
+    Generates a maze, or a band of rows of it, with the sidewinder algorithm vectorized over all the cells.
+
+    The first row is a corridor. Every other row is split in runs of cells linked eastwards, each run being linked
+    to the row above by a single passage from one of its cells. The random choices of a cell are drawn from the
+    counter-based generator with its linear index and the seed, so a band of rows is generated without the others
+    and is the same as in the whole maze.
+
+    Inputs:
+        dimensions: Tuple containing the height and the width of the maze.
+        seed: The random seed. The same seed produces the same maze.
+        rows: The first and last (excluded) rows to generate. By default, the whole maze is generated.
+
+    Returns:
+        An array of int8 of shape (number of rows, width) with the exits of each cell.
+    """
+    height, width = dimensions
+    row_start, row_end = (0, height) if rows is None else rows
+
+    # The passages of the row below the band are the southern exits of its last row
+    last_row = min(row_end + 1, height)
+    cells = np.arange(row_start * width, last_row * width, dtype=np.int64)
+
+    # Each cell closes its run, or is linked to the next one. The last cell of a row always closes its run.
+    closes = ((random_numbers(cells, seed, 0) & np.uint64(1)) == 1).reshape(-1, width)
+    closes[:, -1] = True
+    if row_start == 0:
+        closes[0, :-1] = False
+
+    # A random cell of each run is linked to the row above
+    ends = np.flatnonzero(closes)
+    starts = np.insert(ends[:-1] + 1, 0, 0)
+    passages = starts + (random_numbers(cells[ends], seed, 1) % (ends - starts + 1).astype(np.uint64)).astype(np.intp)
+    has_north_exit = np.zeros(closes.size, dtype=bool)
+    has_north_exit[passages] = True
+    has_north_exit = has_north_exit.reshape(closes.shape)
+    if row_start == 0:
+        has_north_exit[0] = False
+
+    maze = np.zeros(closes.shape, dtype=np.int8)
+    maze[:, :-1][~closes[:, :-1]] |= EAST
+    maze[:, 1:][~closes[:, :-1]] |= WEST
+    maze[has_north_exit] |= NORTH
+    maze[:-1][has_north_exit[1:]] |= SOUTH
+    return maze[:row_end - row_start]
+
 
 class Maze:
     """
@@ -18,70 +121,170 @@ class Maze:
     Inputs:
         dimensions: Tuple containing two integers describing the height and length of the maze.
         seed: The random seed used to generate the maze. The same seed produces the same maze.
+        algorithm: "dfs" for a randomized depth-first search, "sidewinder" for the sidewinder algorithm, much faster
+            on large mazes.
+        comm: When given with the sidewinder algorithm, the processes of this communicator generate the maze
+            together, each one a band of rows.
+        cells: The exits of the cells of an existing maze (for example memory-mapped from a checkpoint), used
+            instead of generating a new one.
+
+    Lookup tables built once, indexed by the linear index row * width + column of a cell:
+        exits: The exit flags of each cell (a flat view of maze).
+        has_exits: Boolean array of shape (height * width, 4), whether the cell has an exit in each direction,
+            indexed by the direction constants.
+        neighbours: Linear index of the neighbour reached through each exit, -1 where there is no exit.
+        nb_exits: Number of exits of each cell.
+        is_dead_end: Whether each cell has a single exit.
     """
 
-    def __init__(self, dimensions, seed):
+    def __init__(self, dimensions, seed, algorithm="dfs", comm=None, cells=None):
         self.cases_img = []
-        self.maze = np.zeros(dimensions, dtype=np.int8)
-        is_visited = np.zeros(dimensions, dtype=np.int8)
-        historic = []
-
-        # We choose the central cell as the initial cell.
-        cur_ind = (dimensions[0] // 2, dimensions[1] // 2)
-        historic.append(cur_ind)
-
-        while len(historic) > 0:
-            cur_ind = historic[-1]
-            is_visited[cur_ind] = 1
-
-            # Check if there is at least one unvisited neighboring cell of the current cell:
-            neighbours = []
-            direction = []
-
-            if cur_ind[1] > 0 and is_visited[cur_ind[0], cur_ind[1] - 1] == 0:  # West cell not visited
-                neighbours.append((cur_ind[0], cur_ind[1] - 1))
-                direction.append((WEST, EAST))
-
-            if cur_ind[1] < dimensions[1] - 1 and is_visited[cur_ind[0], cur_ind[1] + 1] == 0:  # East cell
-                neighbours.append((cur_ind[0], cur_ind[1] + 1))
-                direction.append((EAST, WEST))
-
-            if cur_ind[0] < dimensions[0] - 1 and is_visited[cur_ind[0] + 1, cur_ind[1]] == 0:  # South cell
-                neighbours.append((cur_ind[0] + 1, cur_ind[1]))
-                direction.append((SOUTH, NORTH))
-
-            if cur_ind[0] > 0 and is_visited[cur_ind[0] - 1, cur_ind[1]] == 0:  # North cell
-                neighbours.append((cur_ind[0] - 1, cur_ind[1]))
-                direction.append((NORTH, SOUTH))
-
-            if neighbours:
-                neighbours = np.array(neighbours)
-                direction = np.array(direction)
-                seed = (16807 * seed) % 2147483647
-                chosen_dir = seed % len(neighbours)
-                dir = direction[chosen_dir]
-                historic.append((neighbours[chosen_dir, 0], neighbours[chosen_dir, 1]))
-                self.maze[cur_ind] |= dir[0]
-                self.maze[neighbours[chosen_dir, 0], neighbours[chosen_dir, 1]] |= dir[1]
-                is_visited[cur_ind] = 1
-            else:
-                historic.pop()
-
-        # Load patterns for maze display
-        img = pg.image.load("cases.png").convert_alpha()
-        for i in range(0, 128, 8):
-            self.cases_img.append(pg.Surface.subsurface(img, i, 0, 8, 8))
+        self.maze_img = None
+        self.directions_to = {}
+
+        if cells is not None:
+            assert cells.shape == tuple(dimensions), "The cells do not have the dimensions of the maze"
+            self.maze = cells
+        elif algorithm == "dfs":
+            self.maze = generate_depth_first(dimensions, seed)
+        elif algorithm == "sidewinder" and comm is None:
+            self.maze = generate_sidewinder(dimensions, seed)
+        elif algorithm == "sidewinder":
+            # Each process generates a band of rows, then the bands are shared by all the processes
+            row_starts = np.array([dimensions[0] * i // comm.Get_size() for i in range(comm.Get_size() + 1)])
+            band = generate_sidewinder(dimensions, seed, row_starts[comm.Get_rank():comm.Get_rank() + 2])
+            self.maze = np.empty(dimensions, dtype=np.int8)
+            comm.Allgatherv(band, [self.maze, (np.diff(row_starts) * dimensions[1], row_starts[:-1] * dimensions[1])])
+        else:
+            raise ValueError(f"Unknown maze generation algorithm: {algorithm}")
+
+        self._build_lookup_tables()
+
+    def _build_lookup_tables(self):
+        """
+        Builds the tables describing the cells of the maze, so that the ants get everything about their cells
+        with a single gather.
+        """
+        height, width = self.maze.shape
+        self.exits = self.maze.ravel()
+        self.has_exits = np.bitwise_and(self.exits[:, np.newaxis], np.array(DIRECTION_FLAGS, dtype=np.int8)) > 0
+        offsets = np.array(d.ROW_OFFSETS) * width + np.array(d.COL_OFFSETS)
+        self.neighbours = np.where(self.has_exits, np.arange(height * width, dtype=np.int32)[:, np.newaxis]
+                                   + offsets.astype(np.int32), np.int32(-1))
+        self.nb_exits = np.count_nonzero(self.has_exits, axis=1).astype(np.int8)
+        self.is_dead_end = self.nb_exits == 1
+
+    def get_cell_indices(self, positions):
+        """
+        Converts positions in the maze to the linear indices of the lookup tables.
+
+        Inputs:
+            positions: Array of shape (n, 2) with the row and the column of each position.
+
+        Returns:
+            Array of n linear indices.
+        """
+        return positions[:, 0].astype(np.intp) * self.maze.shape[1] + positions[:, 1]
 
     def display(self):
         """
         Create a picture of the maze.
+
+        The maze never changes, so the picture is built once and reused by the following calls.
+        """
+        if self.maze_img is None:
+            # Load patterns for maze display (requires a display)
+            img = pg.image.load("cases.png").convert_alpha()
+            for i in range(0, 128, 8):
+                self.cases_img.append(pg.Surface.subsurface(img, i, 0, 8, 8))
+
+            self.maze_img = pg.Surface((8 * self.maze.shape[1], 8 * self.maze.shape[0]), flags=pg.SRCALPHA)
+            self.maze_img.blits([(self.cases_img[self.maze[i, j]], (j * 8, i * 8))
+                                 for i in range(self.maze.shape[0]) for j in range(self.maze.shape[1])],
+                                doreturn=False)
+
+        return self.maze_img
+
+    def get_directions_to(self, targets):
+        """
+        Gives, for each cell, the direction to follow to get closer to the nearest target cell.
+
+        The directions are computed once per set of targets by a breadth-first search starting from all the targets,
+        so following them from any cell leads to the nearest target by the shortest path. As the maze is perfect, it
+        is also the only path without loops between the cell and this target.
+        The search is the compiled one of scipy, on the graph of the cells linked by their exits, with an extra node
+        linked to all the targets as the single start: each cell goes towards its predecessor in the search.
+
+        Inputs:
+            targets: Tuple containing the row and the column of the target cell, or array of shape (n, 2) with the
+                rows and the columns of several target cells.
+
+        Returns:
+            A NumPy array of the dimensions of the maze with the direction to follow from each cell
+            (DIR_NONE for the target cells themselves).
         """
-        maze_img = pg.Surface((8 * self.maze.shape[1], 8 * self.maze.shape[0]), flags=pg.SRCALPHA)
-        for i in range(self.maze.shape[0]):
-            for j in range(self.maze.shape[1]):
-                maze_img.blit(self.cases_img[self.maze[i, j]], (j * 8, i * 8))
+        targets = tuple(map(tuple, np.reshape(targets, (-1, 2)).tolist()))
+        if targets not in self.directions_to:
+            height, width = self.maze.shape
+            nb_cells = height * width
+            # Adjacency of the cells in the order of their exits, then of the start node in the order of the targets,
+            # so the search visits the cells in the same order as a queue filled exit by exit
+            starts = np.array([row * width + col for row, col in targets], dtype=np.int32)
+            indices = np.concatenate((self.neighbours[self.has_exits], starts))
+            indptr = np.zeros(nb_cells + 2, dtype=np.int32)
+            np.cumsum(self.nb_exits, out=indptr[1:-1])
+            indptr[-1] = indices.shape[0]
+            # (with the double weights scipy works on, which it would otherwise convert in a copy with sorted indices)
+            graph = sparse.csr_matrix((np.ones(indices.shape[0]), indices, indptr), shape=(nb_cells + 1, nb_cells + 1))
+            _, predecessors = csgraph.breadth_first_order(graph, nb_cells, return_predecessors=True)
 
-        return maze_img
+            # The direction of a cell is the exit leading to its predecessor, none for the targets and the cells
+            # the targets cannot reach
+            predecessors = predecessors[:nb_cells]
+            directions = np.full(nb_cells, d.DIR_NONE, dtype=np.int8)
+            cells = np.flatnonzero(np.logical_and(predecessors >= 0, predecessors < nb_cells)).astype(np.int32)
+            offsets = predecessors[cells] - cells
+            directions[cells] = np.select([offsets == -width, offsets == width, offsets == 1],
+                                          [d.DIR_NORTH, d.DIR_SOUTH, d.DIR_EAST], d.DIR_WEST)
+            self.directions_to[targets] = directions.reshape(height, width)
+
+        return self.directions_to[targets]
+
+
+class Sites:
+    """
+    Cells of the maze holding the food sources, or the nests.
+
+    The sites are numbered in the order of their positions, and a grid of the dimensions of the maze stores the
+    number of the site of each cell (-1 for the other cells), so finding the sites reached by any number of ants is a
+    single gather, whatever the number of sites.
+    """
+
+    def __init__(self, dimensions, positions):
+        """
+        Inputs:
+            dimensions: Tuple containing the height and the width of the maze.
+            positions: Sequence of (row, column) tuples, the positions of the sites, in distinct cells.
+        """
+        self.positions = np.array(positions, dtype=np.int16).reshape(-1, 2)
+        assert self.positions.shape[0] <= np.iinfo(np.int16).max, "There are too many sites to number them in int16"
+        self.grid = np.full(dimensions, -1, dtype=np.int16)
+        self.grid[self.positions[:, 0], self.positions[:, 1]] = np.arange(self.positions.shape[0], dtype=np.int16)
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def get_ids(self, positions):
+        """
+        Gives the site of each of the given cells.
+
+        Inputs:
+            positions: Array of shape (n, 2) with the rows and the columns of the cells.
+
+        Returns:
+            A NumPy array with the number of the site of each cell, -1 when there is none.
+        """
+        return self.grid[positions[:, 0], positions[:, 1]]
 
 
 if __name__ == "__main__":
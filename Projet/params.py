@@ -22,11 +22,11 @@ def get_max_life(default_max_life=500):
 
 
 def get_pos_food(size_laby):
-    return size_laby[0] - 1, size_laby[1] - 1
+    return [(size_laby[0] - 1, size_laby[1] - 1)]
 
 
 def get_pos_nest():
-    return 0, 0
+    return [(0, 0)]
 
 
 def get_alpha(default_alpha=0.9):
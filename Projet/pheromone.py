@@ -1,38 +1,142 @@
 import numpy as np
+import pygame as pg
 import direction as d
 
+# Size in pixels of a cell of the maze on the screen
+CELL_SIZE = 8
+
+# Types of the pheromone levels. The fixed-point levels are stored in int16 (so that -1 can mark the cells not marked
+# by the ants of a process, see Colony.advance), the level 1 of the food being stored as FIXED_POINT_ONE.
+PHEROMONE_DTYPES = {"float64": np.float64, "float32": np.float32, "fixed16": np.int16}
+FIXED_POINT_ONE = 32767
+
 
 class Pheromon:
     """
     Class representing pheromones in the maze.
     """
 
-    def __init__(self, dimensions, food_position, alpha=0.7, beta=0.9999):
+    def __init__(self, dimensions, food_positions, alpha=0.7, beta=0.9999, rows=None, threshold=0., dtype="float64"):
         """
         Initializes the Pheromon object.
 
         Args:
             dimensions (tuple): The dimensions of the maze.
-            food_position (tuple): The position of the food in the maze.
+            food_positions: The position of the food in the maze, as a tuple, or the positions of several food
+                sources, as an array of shape (n, 2).
             alpha (float): The evaporation rate of pheromones.
             beta (float): The persistence rate of pheromones.
+            rows (tuple): The first and last (excluded) rows of the maze whose pheromones are stored.
+                By default, the pheromones of the whole maze are stored.
+            threshold (float): Pheromone levels falling below this threshold by evaporation are set to zero, so
+                that the evaporation only handles the region reached by the ants. By default, no level is truncated.
+            dtype (str): Type of the pheromone levels, one of PHEROMONE_DTYPES. The smaller types reduce the memory
+                and the communications of the pheromones, at the price of their precision. The fixed-point levels
+                are rounded when marked, and truncated when evaporated, so that they keep decreasing to zero.
         """
         self.alpha = alpha
         self.beta = beta
+        self.dtype = dtype
+        self.is_fixed_point = dtype == "fixed16"
+        # Stored value of the level 1
+        self.scale = FIXED_POINT_ONE if self.is_fixed_point else 1.
+        self.threshold = threshold * self.scale
+        self.surface = None
+        self.row_start, self.row_end = (0, dimensions[0]) if rows is None else rows
+
+        # We add a row of cells at the bottom, top, left, and right to facilitate edge management in vectorized form.
+        # When only a band of rows is stored, the top and bottom rows are the ghost rows of the neighbouring bands.
+        self.pheromon = np.zeros((self.row_end - self.row_start + 2, dimensions[1] + 2), dtype=PHEROMONE_DTYPES[dtype])
+        self.active_region = None
+        self.set_food(food_positions)
+
+        # Buffers of the merge of the marks of several processes (see mark_for_merge), allocated at the first merge
+        self.marks = None
+        self.merged = None
+        self.marked_cells = None
+        self.merge_request = None
+        self.pending_evaporation = None
+
+    def set_food(self, pos_food):
+        """
+        Sets the pheromone level of the food cells to its maximum, for the ones which are stored.
+
+        Args:
+            pos_food: The position of the food in the maze, as a tuple, or the positions of several food sources,
+                as an array of shape (n, 2).
+        """
+        pos_food = np.reshape(pos_food, (-1, 2))
+        rows = pos_food[:, 0].astype(np.intp) - self.row_start + 1
+        is_stored = np.logical_and(rows >= 0, rows < self.pheromon.shape[0])
+        if is_stored.any():
+            rows, cols = rows[is_stored], pos_food[is_stored, 1].astype(np.intp) + 1
+            self.pheromon[rows, cols] = self.scale
+            self.active_region = self._merge_boxes(self.active_region, (int(rows.min()), int(rows.max()) + 1,
+                                                                        int(cols.min()), int(cols.max()) + 1))
+
+    def update_active_region(self):
+        """
+        Computes the active region: the smallest box of cells of the pheromone array holding all its non-zero levels.
+        """
+        self.active_region = self._get_non_zero_box(self.pheromon, 0, 0)
 
-        # We add a row of cells at the bottom, top, left, and right to facilitate edge management in vectorized form
-        self.pheromon = np.zeros((dimensions[0] + 2, dimensions[1] + 2), dtype=np.double)
-        self.pheromon[food_position[0] + 1, food_position[1] + 1] = 1.
+    @staticmethod
+    def _get_non_zero_box(levels, row_offset, col_offset):
+        """
+        Returns the first and last (excluded) rows and columns of the non-zero levels of an array, shifted by the given
+        offsets, or None if all the levels are zero.
+        """
+        rows = np.flatnonzero(np.any(levels != 0., axis=1))
+        if rows.shape[0] == 0:
+            return None
+        cols = np.flatnonzero(np.any(levels[rows[0]:rows[-1] + 1] != 0., axis=0))
+        return (int(row_offset + rows[0]), int(row_offset + rows[-1] + 1), int(col_offset + cols[0]),
+                int(col_offset + cols[-1] + 1))
+
+    @staticmethod
+    def _merge_boxes(box, other):
+        """
+        Returns the smallest box containing two boxes, any of them being None if empty.
+        """
+        if box is None or other is None:
+            return other if box is None else box
+        return min(box[0], other[0]), max(box[1], other[1]), min(box[2], other[2]), max(box[3], other[3])
 
     def do_evaporation(self, pos_food):
         """
-        Performs evaporation of pheromones in the maze.
+        Performs evaporation of pheromones in the maze, in place and only in the region where the levels may be
+        non-zero.
+
+        The ants mark a cell from the levels of its neighbours, so during a step the non-zero levels only spread to
+        the neighbours of the active region. The ghost rows, received from the neighbouring bands, are also added to
+        it. Outside this region, all the levels are zero and stay zero, so the result is the same as evaporating
+        the whole array.
+
+        While a merge of marks is in progress, the evaporation is only done when the merge is completed.
 
         Args:
-            pos_food (tuple): The position of the food in the maze.
+            pos_food: The position of the food in the maze, or the positions of several food sources (see set_food).
         """
-        self.pheromon = self.beta * self.pheromon
-        self.pheromon[pos_food[0] + 1, pos_food[1] + 1] = 1.
+        if self.merge_request is not None:
+            self.pending_evaporation = pos_food
+            return
+
+        height, width = self.pheromon.shape
+        region = self.active_region
+        if region is not None:
+            region = max(region[0] - 1, 0), min(region[1] + 1, height), max(region[2] - 1, 0), min(region[3] + 1, width)
+        for ghost_row in (0, height - 1):
+            region = self._merge_boxes(region, self._get_non_zero_box(self.pheromon[ghost_row:ghost_row + 1],
+                                                                      ghost_row, 0))
+
+        if region is not None:
+            levels = self.pheromon[region[0]:region[1], region[2]:region[3]]
+            np.multiply(levels, self.beta, out=levels, casting="unsafe")
+            if self.threshold > 0.:
+                levels[levels < self.threshold] = 0.
+                region = self._get_non_zero_box(levels, region[0], region[2])
+        self.active_region = region
+        self.set_food(pos_food)
 
     def mark(self, position, has_WESN_exits, old_pheromones):
         """
@@ -51,7 +155,83 @@ class Pheromon:
                           old_pheromones[position[0], position[1] + 1] if has_WESN_exits[d.DIR_NORTH] else 0.],
                          dtype=np.double)
         pheromones = np.maximum(cells, 0.)
-        self.pheromon[position[0] + 1, position[1] + 1] = self.alpha * np.max(pheromones) + (1 - self.alpha) * 0.25 * pheromones.sum()
+        value = self.alpha * np.max(pheromones) + (1 - self.alpha) * 0.25 * pheromones.sum()
+        self.pheromon[position[0] + 1, position[1] + 1] = np.rint(value) if self.is_fixed_point else value
+
+    def mark_many(self, positions, exits, old_pheromones, out=None):
+        """
+        Marks pheromones at the positions of several ants in a single vectorized pass.
+
+        Gives the same result as calling `mark` for each ant in turn: when several ants
+        stand on the same cell, the largest marked value is kept. All the marks are computed
+        before being written, so old_pheromones may be the pheromone matrix itself.
+
+        Args:
+            positions (numpy.ndarray): Array of shape (n, 2) with the positions to mark.
+            exits (numpy.ndarray): Boolean array of shape (n, 4) indicating the presence of exits,
+                indexed by the direction constants of the direction module.
+            old_pheromones (numpy.ndarray): The old pheromone matrix.
+            out (numpy.ndarray): The matrix receiving the marks, by default the pheromone matrix.
+        """
+        if positions.shape[0] == 0:
+            return
+        assert np.all(positions >= 0)
+        rows = positions[:, 0].astype(np.intp) - self.row_start + 1
+        cols = positions[:, 1].astype(np.intp) + 1
+        west = np.maximum(np.where(exits[:, d.DIR_WEST], old_pheromones[rows, cols - 1], 0.), 0.)
+        east = np.maximum(np.where(exits[:, d.DIR_EAST], old_pheromones[rows, cols + 1], 0.), 0.)
+        south = np.maximum(np.where(exits[:, d.DIR_SOUTH], old_pheromones[rows + 1, cols], 0.), 0.)
+        north = np.maximum(np.where(exits[:, d.DIR_NORTH], old_pheromones[rows - 1, cols], 0.), 0.)
+        # Same summation order as in `mark` so that the results are bitwise identical
+        values = self.alpha * np.maximum(np.maximum(west, east), np.maximum(south, north)) + \
+            (1 - self.alpha) * 0.25 * (((west + east) + south) + north)
+        # The marks are a weighted mean of the levels, so they are computed the same way on the stored values
+        if self.is_fixed_point:
+            values = np.rint(values)
+
+        # Sort by value so that, for cells marked by several ants, the largest value is written last
+        order = np.argsort(values, kind="stable")
+        (self.pheromon if out is None else out)[rows[order], cols[order]] = values[order]
+
+    def mark_for_merge(self, positions, exits):
+        """
+        Marks the cells of the ants of the current process in a buffer of marks, where the cells not marked are -1,
+        for the marks of all the processes to be merged by a reduction with the MAX operation.
+
+        The reduction is started by the caller, which stores its request in merge_request, and the merged marks are
+        written in the pheromone matrix by complete_merge. Until then, the pheromone matrix keeps its levels.
+
+        Args:
+            positions (numpy.ndarray): Array of shape (n, 2) with the positions to mark.
+            exits (numpy.ndarray): Boolean array of shape (n, 4) indicating the presence of exits.
+
+        Returns:
+            tuple: The buffer of marks to reduce, and the buffer receiving the merged marks.
+        """
+        if self.marks is None:
+            self.marks = np.full_like(self.pheromon, -1)
+            self.merged = np.empty_like(self.pheromon)
+        self.mark_many(positions, exits, self.pheromon, self.marks)
+        self.marked_cells = (positions[:, 0].astype(np.intp) - self.row_start + 1, positions[:, 1].astype(np.intp) + 1)
+        return self.marks, self.merged
+
+    def complete_merge(self):
+        """
+        Waits for the merge of the marks in progress, if any, writes the merged marks in the pheromone matrix and
+        performs the evaporation postponed during the merge.
+        """
+        if self.merge_request is None:
+            return
+        self.merge_request.Wait()
+        self.merge_request = None
+
+        # Only the cells marked by the current process have to be reset for the next merge
+        self.marks[self.marked_cells] = -1
+        np.copyto(self.pheromon, self.merged, where=self.merged >= 0)
+
+        if self.pending_evaporation is not None:
+            pos_food, self.pending_evaporation = self.pending_evaporation, None
+            self.do_evaporation(pos_food)
 
     def get_color(self, i: int, j: int):
         """
@@ -64,9 +244,23 @@ class Pheromon:
         Returns:
             list: The RGB color representation of pheromones at the specified position.
         """
-        val = max(min(self.pheromon[i, j], 1), 0)
+        val = max(min(self.pheromon[i, j] / self.scale, 1), 0)
         return [255 * (val > 1.E-16), 255 * val, 128.]
 
+    def get_colors(self):
+        """
+        Get the color representation of pheromones for every cell of the maze.
+
+        Returns:
+            numpy.ndarray: Array of shape (height, width, 3) with the RGB color of each cell.
+        """
+        val = np.clip(self.pheromon[1:-1, 1:-1] / self.scale, 0, 1)
+        colors = np.empty(val.shape + (3,), dtype=np.uint8)
+        colors[:, :, 0] = 255 * (val > 1.E-16)
+        colors[:, :, 1] = 255 * val
+        colors[:, :, 2] = 128
+        return colors
+
     def display(self, screen):
         """
         Displays the pheromone levels on the screen.
@@ -74,6 +268,10 @@ class Pheromon:
         Args:
             screen: The Pygame screen object.
         """
-        for i in range(1, self.pheromon.shape[0] - 1):
-            for j in range(1, self.pheromon.shape[1] - 1):
-                screen.fill(self.get_color(i, j), (8 * (j - 1), 8 * (i - 1), 8, 8))
+        colors = self.get_colors()
+        # Each cell is drawn as a CELL_SIZE x CELL_SIZE square, and surfarray expects (x, y) indexing
+        pixels = np.repeat(np.repeat(colors, CELL_SIZE, axis=0), CELL_SIZE, axis=1).transpose(1, 0, 2)
+        if self.surface is None or self.surface.get_size() != pixels.shape[:2]:
+            self.surface = pg.Surface(pixels.shape[:2])
+        pg.surfarray.blit_array(self.surface, pixels)
+        screen.blit(self.surface, (0, 0))
@@ -0,0 +1,193 @@
+"""
+Parameter sweeps of the ant colony simulation.
+
+Every combination of the given values of alpha, beta, max_life and the exploration coefficient is run with
+`main_mpi.py --headless`, each run being a small MPI job, several of them at a time to use all the cores. The maze is
+generated once and saved in shared memory (/dev/shm when available), where all the runs map it instead of generating
+it again. The food collected, the step and time of the first food brought back, and the food collected along the run
+are written as a single table, one row per run, as CSV and JSON.
+"""
+import argparse
+import csv
+import itertools
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import maze
+
+# Directory of the shared memory on Linux
+SHARED_MEMORY = "/dev/shm"
+
+
+def parse_arguments():
+    """
+    Parses the command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Parameter sweeps of the ant colony simulation.")
+    parser.add_argument("--alpha", type=float, nargs="+", default=[0.9], help="evaporation rates of pheromones")
+    parser.add_argument("--beta", type=float, nargs="+", default=[0.99], help="persistence rates of pheromones")
+    parser.add_argument("--max-life", type=int, nargs="+", default=[500], help="maximal lives of an ant")
+    parser.add_argument("--exploration", type=float, nargs="+", default=[0.],
+                        help="probabilities for an ant to explore the maze even if pheromones could guide it")
+    parser.add_argument("--size", default="25x25", help="maze size as HEIGHTxWIDTH")
+    parser.add_argument("--ants", type=int, default=None,
+                        help="number of ants, by default one ant for four cells of the maze")
+    parser.add_argument("--maze", choices=["dfs", "sidewinder"], default="dfs",
+                        help="algorithm generating the maze shared by the runs")
+    parser.add_argument("--steps", type=int, default=1000, help="number of simulation steps of each run")
+    parser.add_argument("--curve-every", type=int, default=10, metavar="STEPS",
+                        help="the food collected is recorded every STEPS steps")
+    parser.add_argument("--processes", type=int, default=2, help="number of MPI processes of each run, rank 0 included")
+    parser.add_argument("--jobs", type=int, default=None,
+                        help="number of runs at a time, by default as many as fit on the cores")
+    parser.add_argument("--timeout", type=float, default=600, help="maximal duration of a run in seconds")
+    parser.add_argument("--mpiexec", default="mpiexec", help="command launching the MPI processes")
+    parser.add_argument("--mpiexec-args", default="--bind-to none",
+                        help="additional arguments of the MPI launcher (by default, the processes are not bound to "
+                             "cores, as the runs at the same time would all be bound to the same ones)")
+    parser.add_argument("--output", default="sweep", help="directory receiving the results")
+    arguments = parser.parse_args()
+    arguments.size = parse_size(arguments.size)
+    if arguments.processes < 2:
+        parser.error("at least 2 processes are needed, rank 0 only displays the simulation")
+    if arguments.jobs is None:
+        arguments.jobs = max(1, (os.cpu_count() or 1) // arguments.processes)
+    return arguments
+
+
+def parse_size(size):
+    """
+    Converts a maze size written HEIGHTxWIDTH to a tuple of integers.
+    """
+    height, width = size.lower().split("x")
+    return int(height), int(width)
+
+
+def get_configurations(arguments):
+    """
+    Lists the combinations of parameters to run.
+
+    Returns:
+        list: One dictionary of parameters per run.
+    """
+    return [{"alpha": alpha, "beta": beta, "max_life": max_life, "exploration": exploration}
+            for alpha, beta, max_life, exploration in itertools.product(arguments.alpha, arguments.beta,
+                                                                        arguments.max_life, arguments.exploration)]
+
+
+def share_maze(arguments):
+    """
+    Generates the maze of the runs and saves it in shared memory.
+
+    Returns:
+        tuple: The temporary directory holding the maze, to remove at the end of the sweep, and the path of the maze.
+    """
+    directory = tempfile.mkdtemp(prefix="ant_sweep_", dir=SHARED_MEMORY if os.path.isdir(SHARED_MEMORY) else None)
+    path = os.path.join(directory, "maze.npy")
+    # The same seed as main_mpi.py, so the runs simulate the maze they would generate
+    np.save(path, maze.Maze(arguments.size, 12345, arguments.maze).maze)
+    return directory, path
+
+
+def execute_run(configuration, arguments, maze_file):
+    """
+    Runs the simulation once in headless mode, with the shared maze.
+
+    Returns:
+        dict: The metrics printed by the simulation, or None if the run failed or timed out.
+    """
+    height, width = arguments.size
+    command = [arguments.mpiexec, *shlex.split(arguments.mpiexec_args), "-n", str(arguments.processes),
+               sys.executable, "main_mpi.py", str(height), str(width), str(configuration["max_life"]),
+               str(configuration["alpha"]), str(configuration["beta"]), str(arguments.steps),
+               "--exploration", str(configuration["exploration"]), "--maze", arguments.maze,
+               "--maze-file", maze_file, "--headless", "--food-history", str(arguments.curve_every)]
+    if arguments.ants is not None:
+        command += ["--ants", str(arguments.ants)]
+
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, timeout=arguments.timeout,
+                                 cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        print(f"Execution of {' '.join(command)} timed out.", file=sys.stderr)
+        return None
+    if process.returncode != 0:
+        print(f"Execution of {' '.join(command)} failed:\n{process.stderr}", file=sys.stderr)
+        return None
+
+    # The metrics are the last line of the output, after the messages of the libraries
+    for line in reversed(process.stdout.splitlines()):
+        if line.startswith("{"):
+            return json.loads(line)
+    print(f"Execution of {' '.join(command)} did not report its metrics.", file=sys.stderr)
+    return None
+
+
+def get_result(configuration, metrics):
+    """
+    Builds the row of a run in the results table.
+
+    The food curve is the food collected every --curve-every steps, its mean per step being its slope.
+    """
+    return {
+        **configuration,
+        "height": metrics["height"],
+        "width": metrics["width"],
+        "ants": metrics["ants"],
+        "steps": metrics["steps"],
+        "steps_per_second": metrics["steps_per_second"],
+        "food": metrics["food"],
+        "food_per_step": metrics["food"] / metrics["steps"],
+        "first_food_step": metrics["first_food_step"],
+        "first_food_time": metrics["first_food_time"],
+        "food_curve": {metrics["food_history_every"] * (index + 1): food
+                       for index, food in enumerate(metrics["food_history"])},
+    }
+
+
+def write_results(output, results):
+    """
+    Writes the results table as CSV and JSON files. In the CSV file, each point of the food curves has its own column.
+    """
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "results.json"), "w") as file:
+        json.dump(results, file, indent=2)
+    if not results:
+        return
+    flat_rows = [{key: value for key, value in row.items() if key != "food_curve"} |
+                 {f"food_at_step_{step}": food for step, food in row["food_curve"].items()} for row in results]
+    with open(os.path.join(output, "results.csv"), "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=list(flat_rows[0]))
+        writer.writeheader()
+        writer.writerows(flat_rows)
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    configurations = get_configurations(arguments)
+    directory, maze_file = share_maze(arguments)
+
+    # The runs are MPI jobs, the threads of the pool only wait for them
+    results = []
+    try:
+        with ThreadPoolExecutor(max_workers=arguments.jobs) as executor:
+            all_metrics = executor.map(lambda configuration: execute_run(configuration, arguments, maze_file),
+                                       configurations)
+            for configuration, metrics in zip(configurations, all_metrics):
+                if metrics is None:
+                    continue
+                results.append(get_result(configuration, metrics))
+                print(f"alpha {configuration['alpha']}, beta {configuration['beta']}, max_life "
+                      f"{configuration['max_life']}, exploration {configuration['exploration']}: "
+                      f"{metrics['food']} food, first food at step {metrics['first_food_step']}")
+    finally:
+        shutil.rmtree(directory)
+
+    write_results(arguments.output, results)
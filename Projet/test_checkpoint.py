@@ -0,0 +1,52 @@
+"""
+Regression tests of the checkpoints, running the simulation with mpiexec.
+"""
+import json
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+PROJECT = os.path.dirname(os.path.abspath(__file__))
+# MPI launcher and its additional arguments, for example MPIEXEC_ARGS="--allow-run-as-root --oversubscribe" with
+# OpenMPI
+MPIEXEC = shutil.which(os.environ.get("MPIEXEC", "mpiexec"))
+MPIEXEC_ARGS = shlex.split(os.environ.get("MPIEXEC_ARGS", ""))
+
+
+def run_headless(steps, *options):
+    """
+    Runs the simulation of a 120x120 maze in headless mode on 3 processes.
+
+    Returns:
+        dict: The metrics printed by the simulation.
+    """
+    command = [MPIEXEC, *MPIEXEC_ARGS, "-n", "3", sys.executable, "main_mpi.py",
+               "120", "120", "500", "0.9", "0.99", str(steps), "--headless", *options]
+    process = subprocess.run(command, capture_output=True, text=True, timeout=120, cwd=PROJECT,
+                             env=dict(os.environ, OMPI_MCA_mpi_yield_when_idle="1"))
+    assert process.returncode == 0, process.stderr
+    return json.loads([line for line in process.stdout.splitlines() if line.startswith("{")][-1])
+
+
+@pytest.mark.skipif(MPIEXEC is None, reason="mpiexec is not available")
+def test_checkpoint_into_restored_directory(tmp_path):
+    """
+    A run restored from a checkpoint can checkpoint into the same directory, whose maze it maps in memory (a
+    120x120 maze spans several pages, which a truncated file cannot map anymore).
+    """
+    path = str(tmp_path / "checkpoint")
+    run_headless(20, "--checkpoint", path)
+    maze_cells = np.load(os.path.join(path, "maze.npy"))
+
+    run_headless(40, "--restore", path, "--checkpoint", path)
+    with open(os.path.join(path, "header.json")) as file:
+        assert json.load(file)["step"] == 40
+    assert np.array_equal(np.load(os.path.join(path, "maze.npy")), maze_cells)
+
+    # The checkpoint is still complete and can be restored again
+    run_headless(60, "--restore", path)